@@ -177,12 +177,46 @@ class Hourai(commands.AutoShardedBot):
     async def on_ready(self):
         log.info(f'Bot Ready: {self.user.name} ({self.user.id})')
 
+    async def on_shard_ready(self, shard_id):
+        self.storage.resize_config_caches(len(self.guilds))
+        guilds = sorted((guild for guild in self.guilds
+                         if guild.shard_id == shard_id),
+                        key=lambda guild: guild.member_count or 0,
+                        reverse=True)
+        # The local caches were just sized for every guild of this process,
+        # so all of the shard's guilds are prefetched.
+        try:
+            await self.storage.prefetch_guild_configs(
+                (guild.id for guild in guilds),
+                name=f'guilds on shard {shard_id}')
+        except Exception:
+            log.exception(f'Failed to prefetch configs for shard {shard_id}:')
+
     async def on_message(self, message):
         if message.author.bot:
             return
+        if isinstance(message.author, discord.Member):
+            self.storage.member_index.add_member(message.author)
         await self.process_commands(message)
 
+    async def on_member_join(self, member):
+        self.storage.member_index.add_member(member)
+
+    async def on_member_update(self, before, after):
+        self.storage.member_index.add_member(after)
+
+    async def on_member_remove(self, member):
+        self.storage.member_index.remove_member(member)
+
+    async def on_guild_available(self, guild):
+        self.storage.member_index.add_guild(guild)
+
+    async def on_guild_join(self, guild):
+        self.storage.member_index.add_guild(guild)
+        self.storage.resize_config_caches(len(self.guilds))
+
     async def on_guild_remove(self, guild):
+        self.storage.member_index.remove_guild(guild)
         try:
             del self.guild_proxies[guild.id]
         except KeyError:
@@ -1,11 +1,30 @@
 import discord
 import asyncio
+import collections
 import typing
 from datetime import datetime, timedelta
+from sqlalchemy import or_
 from hourai import utils
 from hourai.utils import fake, format
 from hourai.db import models, proto, escalation_history
 
+# How long claimed pending actions are reserved for the claiming worker.
+# Actions claimed by a worker that crashed are claimed again once it passes.
+PENDING_ACTION_LEASE = timedelta(minutes=5)
+# How often the lease of pending actions being executed is renewed.
+PENDING_ACTION_RENEW_INTERVAL = PENDING_ACTION_LEASE / 3
+# Maximum number of pending actions claimed and executed at once.
+PENDING_ACTION_BATCH_SIZE = 500
+# Maximum number of pending actions executed concurrently in a single guild.
+MAX_GUILD_CONCURRENCY = 5
+# Action types applied with a member edit. Consecutive ones for the same
+# member are merged into a single edit.
+MEMBER_EDIT_ACTIONS = frozenset(('change_role', 'mute', 'deafen'))
+# The discord.VoiceState attribute holding the state set by each voice action.
+VOICE_STATE_ATTRS = {'mute': 'mute', 'deafen': 'deaf'}
+# Maximum length of an audit log reason.
+MAX_REASON_LENGTH = 512
+
 
 def _get_reason(action: proto.Action) -> str:
     if action.HasField('reason'):
@@ -13,6 +32,15 @@ def _get_reason(action: proto.Action) -> str:
     return None
 
 
+def _get_voice_status(status_type: proto.StatusType) -> bool:
+    return {
+        proto.StatusType.APPLY: True,
+        proto.StatusType.UNAPPLY: False,
+        # TODO(james7132): Implement this properly
+        proto.StatusType.TOGGLE: False,
+    }[status_type]
+
+
 # TODO(james7132): Log the actions to the log and to modlogs
 class ActionManager:
 
@@ -38,23 +66,146 @@ class ActionScheduler:
 
     def schedule(self, timestamp: int,
                 *actions: typing.Iterable[proto.Action]) -> None:
-        """Schedules an action to be done in the future."""
+        """Schedules an action to be done in the future.
+
+        Dispatches an action_scheduled event with the timestamp once saved.
+        """
         session = self.bot.create_storage_session()
         with session:
             for action in actions:
                 session.add(models.PendingAction(timestamp=timestamp,
                                                  data=action))
             session.commit()
+        self.bot.dispatch('action_scheduled', timestamp)
 
-    def query_pending_actions(self, session):
-        """Queries a SQLAlchemy session for of the currently unexecuted pending
-        actions.
+    def query_pending_actions(self, session, until=None):
+        """Queries a SQLAlchemy session for of the unexecuted pending actions
+        that are due before until, or now if not provided.
         """
-        now = datetime.utcnow()
+        until = until or datetime.utcnow()
         return session.query(models.PendingAction) \
-            .filter(models.PendingAction.timestamp < now) \
-            .order_by(models.PendingAction.timestamp) \
+            .filter(models.PendingAction.timestamp < until) \
+            .order_by(models.PendingAction.timestamp)
+
+    async def run_pending_actions(self):
+        """|coro| Claims and executes all due pending actions in batches.
+
+        Claimed actions are leased to this worker, so multiple processes can
+        run this concurrently without executing an action twice. The lease is
+        renewed while the batch runs, and actions whose lease was lost are
+        skipped. Actions for the same user are executed in order, and at
+        most MAX_GUILD_CONCURRENCY users' actions run at once in any guild.
+
+        Returns the IDs of the claimed actions.
+        """
+        storage = self.bot.storage
+        claimed = set()
+        while True:
+            expiration = datetime.utcnow() + PENDING_ACTION_LEASE
+            pending = await storage.run_in_session(
+                self._claim_pending_actions, expiration)
+            if len(pending) <= 0:
+                return claimed
+            claimed.update(action.id for action in pending)
+            batch = _PendingActionBatch(pending, expiration)
+            finished = asyncio.Event()
+            renewal = asyncio.ensure_future(self._renew_lease(batch, finished))
+            try:
+                await self._execute_pending_actions(batch)
+            finally:
+                # Not cancelled, so an in-flight renewal is not lost.
+                finished.set()
+                await renewal
+            await storage.run_in_session(self._delete_pending_actions, batch)
+            if len(pending) < PENDING_ACTION_BATCH_SIZE:
+                return claimed
+
+    def _claim_pending_actions(self, session, expiration):
+        now = datetime.utcnow()
+        lease_expiration = models.PendingAction.lease_expiration
+        # SKIP LOCKED keeps concurrent claims from blocking on, or claiming,
+        # the same rows. Dialects without row locks ignore it.
+        pending = self.query_pending_actions(session, now) \
+            .filter(or_(lease_expiration.is_(None), lease_expiration < now)) \
+            .limit(PENDING_ACTION_BATCH_SIZE) \
+            .with_for_update(skip_locked=True) \
             .all()
+        for action in pending:
+            action.lease_expiration = expiration
+        return pending
+
+    async def _renew_lease(self, batch, finished):
+        while not finished.is_set():
+            try:
+                await asyncio.wait_for(
+                    finished.wait(),
+                    PENDING_ACTION_RENEW_INTERVAL.total_seconds())
+                return
+            except asyncio.TimeoutError:
+                pass
+            expiration = datetime.utcnow() + PENDING_ACTION_LEASE
+            try:
+                batch.leased_ids = await self.bot.storage.run_in_session(
+                    self._extend_lease, batch, expiration)
+                batch.expiration = expiration
+            except Exception:
+                self.bot.logger.exception(
+                    'Error while renewing pending action lease:')
+
+    def _extend_lease(self, session, batch, expiration):
+        """Extends the lease of the actions still leased by a batch. Returns
+        the IDs of the renewed actions.
+        """
+        leased = self.__query_leased(session, batch, batch.leased_ids) \
+            .with_for_update() \
+            .all()
+        for action in leased:
+            action.lease_expiration = expiration
+        return set(action.id for action in leased)
+
+    def _delete_pending_actions(self, session, batch):
+        self.__query_leased(session, batch, batch.executed_ids) \
+            .delete(synchronize_session=False)
+
+    @staticmethod
+    def __query_leased(session, batch, action_ids):
+        # Actions claimed again by another worker have a different lease.
+        return session.query(models.PendingAction) \
+            .filter(models.PendingAction.id.in_(action_ids)) \
+            .filter(models.PendingAction.lease_expiration == batch.expiration)
+
+    async def _execute_pending_actions(self, batch):
+        guild_limits = collections.defaultdict(
+            lambda: asyncio.Semaphore(MAX_GUILD_CONCURRENCY))
+        by_user = collections.defaultdict(list)
+        for action in batch.actions:
+            by_user[(action.data.guild_id, action.data.user_id)] \
+                .append(action)
+
+        async def execute_in_order(guild_id, actions):
+            async with guild_limits[guild_id]:
+                actions = [action for action in actions
+                           if batch.is_leased(action)]
+                batch.executed_ids.update(action.id for action in actions)
+                await self.bot.action_manager.sequentially_execute(
+                    [action.data for action in actions])
+
+        await asyncio.gather(*[execute_in_order(guild_id, actions)
+                               for (guild_id, _), actions in by_user.items()])
+
+
+class _PendingActionBatch:
+    """Pending actions claimed by a worker, and the lease on them."""
+
+    def __init__(self, actions, expiration):
+        self.actions = actions
+        self.expiration = expiration
+        self.leased_ids = set(action.id for action in actions)
+        self.executed_ids = set()
+
+    def is_leased(self, action):
+        return action.id in self.leased_ids and \
+            datetime.utcnow() < self.expiration
 
 
 class ActionExecutor:
@@ -64,26 +215,42 @@ class ActionExecutor:
 
     async def sequentially_execute(self,
             actions: typing.Iterable[proto.Action]) -> None:
-        """Executes multiple actions sequentially."""
-        for action in actions:
-            await self.execute(action)
+        """Executes multiple actions sequentially. Actions that edit the same
+        member are merged, see plan_actions.
+        """
+        for step in plan_actions(actions):
+            await self.__execute_step(step)
 
     async def execute_all(self, actions: typing.Iterable[proto.Action]) -> None:
-        """Executes multiple actions in parallel."""
-        return await asyncio.gather(*[self.execute(a) for a in actions])
+        """Executes multiple actions in parallel. Actions that edit the same
+        member are merged, see plan_actions.
+        """
+        return await asyncio.gather(*[self.__execute_step(step)
+                                      for step in plan_actions(actions)])
 
     async def execute(self, action: proto.Action) -> None:
-        action_type = action.WhichOneof('details')
+        await self.__execute_step((action,))
+
+    async def __execute_step(self, actions) -> None:
+        action_type = actions[0].WhichOneof('details')
+        if len(actions) > 1:
+            step = self._apply_member_edit(actions)
+        else:
+            apply = getattr(self, "_apply_" + str(action_type), None)
+            if apply is None:
+                raise ValueError(f'Action type not supported: {action_type}')
+            step = apply(actions[0])
         try:
-            await getattr(self, "_apply_" + action_type)(action)
-            if not action.HasField('duration'):
-                return
-            # Schedule an undo
-            duration = timedelta(seconds=action.duration)
-            self.bot.action_manager.schedule(datetime.utcnow() + duration,
-                                             invert_action(action))
-        except AttributeError:
-            raise ValueError(f'Action type not supported: {action_type}')
+            # Handlers may return actions that were skipped, which need no
+            # undo.
+            skipped = set(id(action) for action in (await step or ()))
+            for action in actions:
+                if not action.HasField('duration') or id(action) in skipped:
+                    continue
+                # Schedule an undo
+                duration = timedelta(seconds=action.duration)
+                self.bot.action_manager.schedule(datetime.utcnow() + duration,
+                                                 invert_action(action))
         except discord.NotFound:
             # If the guild or the target is not found, silence the error
             pass
@@ -95,6 +262,64 @@ class ActionExecutor:
         except Exception:
             self.bot.logger.exception('Error while executing action:')
 
+    async def _apply_member_edit(self, actions) -> list:
+        """Applies change_role, mute, and deafen actions for the same member,
+        in order, with a single edit. Changes that cancel out are not sent,
+        nor are mutes and deafens of members not connected to voice.
+
+        Returns the mute and deafen actions that were not sent.
+        """
+        member = await self.__get_member(actions[0])
+        if member is None:
+            return []
+        role_ids = set(member._roles)
+        edit = {}
+        for action in actions:
+            action_type = action.WhichOneof('details')
+            assert action_type in MEMBER_EDIT_ACTIONS
+            if action_type == 'change_role':
+                self.__change_role_ids(member.guild, role_ids,
+                                       action.change_role)
+            else:
+                status_type = getattr(action, action_type).type
+                edit[action_type] = _get_voice_status(status_type)
+
+        if role_ids != set(member._roles):
+            roles = (member.guild.get_role(id) for id in role_ids)
+            edit['roles'] = [r for r in roles if r is not None]
+        skipped = []
+        for action_type, attr in VOICE_STATE_ATTRS.items():
+            # Discord rejects voice state edits for members not in voice,
+            # which would also fail the rest of the edit.
+            if action_type in edit and (
+                    member.voice is None or
+                    edit[action_type] == getattr(member.voice, attr)):
+                del edit[action_type]
+                skipped.extend(action for action in actions
+                               if action.WhichOneof('details') == action_type)
+        if len(edit) <= 0:
+            return skipped
+
+        reasons = []
+        for action in actions:
+            reason = _get_reason(action)
+            if reason and reason not in reasons:
+                reasons.append(reason)
+        reason = format.ellipsize('; '.join(reasons), MAX_REASON_LENGTH)
+        await member.edit(reason=reason or None, **edit)
+        return skipped
+
+    @staticmethod
+    def __change_role_ids(guild, role_ids, change_role) -> None:
+        changed = [id for id in change_role.role_ids
+                   if guild.get_role(id) is not None]
+        if change_role.type == proto.StatusType.APPLY:
+            role_ids.update(changed)
+        elif change_role.type == proto.StatusType.UNAPPLY:
+            role_ids.difference_update(changed)
+        elif change_role.type == proto.StatusType.TOGGLE:
+            role_ids.symmetric_difference_update(changed)
+
     async def _apply_kick(self, action: proto.Action) -> None:
         assert action.WhichOneof('details') == 'kick'
         member = await self.__get_member(action)
@@ -115,29 +340,13 @@ class ActionExecutor:
         if action.ban.type != proto.BanMember.BAN:
             await guild.unban(user, reason=_get_reason(action))
 
-    async def _apply_mute(self, action: proto.Action) -> None:
+    async def _apply_mute(self, action: proto.Action) -> list:
         assert action.WhichOneof('details') == 'mute'
-        member = await self.__get_member(action)
-        if member is not None:
-            mute = {
-                proto.StatusType.APPLY: True,
-                proto.StatusType.UNAPPLY: False,
-                # TODO(james7132): Implement this properly
-                proto.MuteMember.TOGGLE: False,
-            }[action.mute.type]
-            await member.edit(mute=mute, reason=_get_reason(action))
-
-    async def _apply_deafen(self, action: proto.Action) -> None:
+        return await self._apply_member_edit((action,))
+
+    async def _apply_deafen(self, action: proto.Action) -> list:
         assert action.WhichOneof('details') == 'deafen'
-        member = await self.__get_member(action)
-        if member is not None:
-            deafen = {
-                proto.StatusType.APPLY: True,
-                proto.StatusType.UNAPPLY: False,
-                # TODO(james7132): Implement this properly
-                proto.StatusType.TOGGLE: False,
-            }[action.deafen.type]
-            await member.edit(deafen=deafen, reason=_get_reason(action))
+        return await self._apply_member_edit((action,))
 
     async def _apply_change_role(self, action: proto.Action) -> None:
         assert action.WhichOneof('details') == 'change_role'
@@ -253,6 +462,35 @@ INVERT_MAPPING = {
 }
 
 
+def plan_actions(actions: typing.Iterable[proto.Action]) -> list:
+    """Groups actions into steps, each a tuple of actions to execute together.
+
+    Consecutive change_role, mute, and deafen actions for the same member are
+    merged into one step, which is applied with a single member edit. Any
+    other action for the member ends the merge, and commands end all merges,
+    as they may depend on the state of any member. Steps keep the relative
+    order of actions for each member.
+    """
+    steps = []
+    merging = {}
+    for action in actions:
+        action_type = action.WhichOneof('details')
+        key = (action.guild_id, action.user_id)
+        if action_type in MEMBER_EDIT_ACTIONS and \
+           action.HasField('guild_id') and action.HasField('user_id'):
+            if key not in merging:
+                merging[key] = len(steps)
+                steps.append([])
+            steps[merging[key]].append(action)
+            continue
+        if action_type == 'command':
+            merging.clear()
+        else:
+            merging.pop(key, None)
+        steps.append([action])
+    return [tuple(step) for step in steps]
+
+
 def invert_action(action: proto.Action) -> proto.Action:
     new_action = proto.Action()
     new_action.CopyFrom(action)
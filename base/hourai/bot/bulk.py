@@ -0,0 +1,141 @@
+import asyncio
+import itertools
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+# Maximum number of operations run at once, across every route.
+DEFAULT_CONCURRENCY = 10
+# Default rate limit of a route, as (operations, seconds).
+DEFAULT_ROUTE_RATE = (5, 1)
+# Jobs with at most this many items are treated as interactive and run ahead
+# of larger ones.
+MAX_INTERACTIVE_SIZE = 5
+
+# Queue priorities. Lower values run first.
+INTERACTIVE = 0
+BULK = 1
+
+
+class TokenBucket:
+    """Limits operations to rate per per seconds, allowing bursts of up to
+    rate operations.
+    """
+
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self._tokens = rate
+        self._updated = time.monotonic()
+
+    def reserve(self):
+        """Consumes a token, borrowing from future refills if none are left.
+        Returns the number of seconds until the operation can be done.
+        """
+        now = time.monotonic()
+        refill = (now - self._updated) * self.rate / self.per
+        self._tokens = min(self.rate, self._tokens + refill) - 1
+        self._updated = now
+        return max(0, -self._tokens * self.per / self.rate)
+
+
+class BulkExecutor:
+    """Runs large batches of API calls with bounded concurrency.
+
+    Operations are queued by priority and run by a fixed pool of workers,
+    paced by the token bucket of their route. Routes are arbitrary hashable
+    keys, usually the kind of operation and the ID of the guild it is done
+    in, mirroring how Discord rate limits requests. Interactive jobs skip
+    ahead of queued bulk work.
+
+    Workers never wait on a route. An operation whose route is out of tokens
+    reserves the next one and is queued again when it is due, so the workers
+    keep running operations for other routes in the meantime.
+    """
+
+    def __init__(self, *, concurrency=DEFAULT_CONCURRENCY,
+                 route_rate=DEFAULT_ROUTE_RATE, route_rates=None,
+                 max_interactive_size=MAX_INTERACTIVE_SIZE):
+        self.concurrency = concurrency
+        self.route_rate = route_rate
+        # Rates for routes, keyed by the first element of the route.
+        self.route_rates = route_rates or {}
+        self.max_interactive_size = max_interactive_size
+        self._queue = asyncio.PriorityQueue()
+        self._counter = itertools.count()
+        self._buckets = {}
+        self._workers = []
+
+    def submit(self, route, func, *args, priority=BULK):
+        """Queues func(*args) to run on route. Returns a future for its
+        result.
+        """
+        future = asyncio.get_event_loop().create_future()
+        # The counter keeps the queue FIFO within a priority.
+        self._queue.put_nowait((priority, next(self._counter), route, func,
+                                args, future, False))
+        self.__ensure_workers()
+        return future
+
+    async def map(self, route, func, items, *, priority=None):
+        """Runs func(item) on route for every item and yields the results in
+        the order they finish. Unfinished operations are cancelled if the
+        iteration stops early.
+
+        If no priority is provided, small batches run as interactive jobs.
+        """
+        items = list(items)
+        if priority is None:
+            priority = INTERACTIVE \
+                if len(items) <= self.max_interactive_size else BULK
+        futures = [self.submit(route, func, item, priority=priority)
+                   for item in items]
+        try:
+            for future in asyncio.as_completed(futures):
+                yield await future
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        self._workers.clear()
+
+    def __ensure_workers(self):
+        while len(self._workers) < self.concurrency:
+            self._workers.append(asyncio.ensure_future(self._work()))
+
+    def _get_bucket(self, route):
+        bucket = self._buckets.get(route)
+        if bucket is None:
+            kind = route[0] if isinstance(route, tuple) else route
+            rate, per = self.route_rates.get(kind, self.route_rate)
+            bucket = self._buckets[route] = TokenBucket(rate, per)
+        return bucket
+
+    async def _work(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            item = await self._queue.get()
+            _, _, route, func, args, future, reserved = item
+            if future.done():
+                continue
+            if not reserved:
+                delay = self._get_bucket(route).reserve()
+                if delay > 0:
+                    loop.call_later(delay, self._queue.put_nowait,
+                                    item[:-1] + (True,))
+                    continue
+            try:
+                result = await func(*args)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as error:
+                if not future.done():
+                    future.set_exception(error)
+            else:
+                if not future.done():
+                    future.set_result(result)
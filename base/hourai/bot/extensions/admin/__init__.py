@@ -1,24 +1,33 @@
-import asyncio
 import discord
 import re
 import typing
 import logging
+import time
 from . import escalation
 from datetime import datetime, timedelta
-from discord.ext import commands, tasks
+from discord.ext import commands
+import sqlalchemy
 from hourai import utils
 from hourai.utils import fake, format
-from hourai.db import proto
-from hourai.bot import cogs
+from hourai.db import models, proto
+from hourai.bot import bulk, cogs, timers
 
 
 MAX_PRUNE_LOOKBACK = timedelta(days=14)
 DELETE_WAIT_DURATION = 60
+# Minimum seconds between edits of the progress message of bulk commands.
+PROGRESS_UPDATE_INTERVAL = 2
+# Minimum delay before retrying due pending actions that another worker had
+# locked or leased.
+PENDING_ACTION_RETRY_DELAY = timedelta(seconds=5)
 
 log = logging.getLogger(__name__)
 
 
-async def batch_do(members, func):
+async def batch_do(executor, route, members, func):
+    """Runs func on every member through a BulkExecutor. Yields (member,
+    result) pairs as they finish.
+    """
     async def _do(member):
         result = ':thumbsup:'
         try:
@@ -28,9 +37,9 @@ async def batch_do(members, func):
         except Exception as e:
             result = str(e)
         identifier = member.name if hasattr(member, 'name') else member.id
-        return f"{identifier}: {result}"
-    results = await asyncio.gather(*[_do(member) for member in members])
-    return dict(zip(members, results))
+        return member, f"{identifier}: {result}"
+    async for result in executor.map(route, _do, members):
+        yield result
 
 
 def create_action(member):
@@ -46,39 +55,105 @@ class Admin(escalation.EscalationMixin, cogs.BaseCog):
 
     def __init__(self, bot):
         self.bot = bot
-        self.apply_pending_actions.start()
+        self.pending_actions = timers.DeadlineTimer(
+            self.load_pending_actions, self.apply_pending_actions)
+        self.pending_actions.start(self.bot.wait_until_ready)
+        self.bulk = self.__create_bulk_executor()
         super().__init__(bot)
 
     def cog_unload(self):
-        self.apply_pending_actions.cancel()
+        self.pending_actions.cancel()
+        self.bulk.close()
         super().cog_unload()
 
-    @tasks.loop(seconds=1)
-    async def apply_pending_actions(self):
+    def __create_bulk_executor(self):
+        def bulk_value(name, default):
+            # Configs are conformed to the template, which fills keys
+            # missing from a partial bulk_actions section with None.
+            value = self.bot.get_config_value(f'bulk_actions.{name}',
+                                              default=None)
+            return default if value is None else value
+
+        rate, per = bulk.DEFAULT_ROUTE_RATE
+        return bulk.BulkExecutor(
+            concurrency=bulk_value('concurrency', bulk.DEFAULT_CONCURRENCY),
+            route_rate=(bulk_value('route_rate', rate),
+                        bulk_value('route_period', per)),
+            max_interactive_size=bulk_value('max_interactive_size',
+                                            bulk.MAX_INTERACTIVE_SIZE))
+
+    @commands.Cog.listener()
+    async def on_action_scheduled(self, timestamp):
+        self.pending_actions.notify(timestamp)
+
+    async def load_pending_actions(self, until):
+        def load(session):
+            query = self.bot.action_manager.query_pending_actions(
+                session, until)
+            return self.__with_deadlines(query).all()
+        return await self.bot.storage.run_in_session(load)
+
+    async def apply_pending_actions(self, action_ids):
+        claimed = set()
         try:
-            session = self.bot.create_storage_session()
-            with session:
-                query = self.bot.action_manager.query_pending_actions(session)
-                for pending_action in query:
-                    await self.bot.action_manager.execute(pending_action.data)
-                    session.delete(pending_action)
-                    session.commit()
+            claimed = await self.bot.action_manager.run_pending_actions()
         except Exception:
             log.exception('Error in running pending action:')
 
-    @apply_pending_actions.before_loop
-    async def before_apply_pending_actions(self):
-        await self.bot.wait_until_ready()
+        # Actions locked or leased by another worker were not claimed. Rearm
+        # them for when they are due again instead of the next reload.
+        unclaimed = set(action_ids) - claimed
+        if len(unclaimed) <= 0:
+            return
+
+        def load(session):
+            query = session.query(models.PendingAction) \
+                .filter(models.PendingAction.id.in_(unclaimed))
+            return self.__with_deadlines(query).all()
+        retry = datetime.utcnow() + PENDING_ACTION_RETRY_DELAY
+        for deadline, action_id in await self.bot.storage.run_in_session(load):
+            self.pending_actions.push(max(deadline, retry), action_id)
+
+    @staticmethod
+    def __with_deadlines(query):
+        # Actions claimed by another worker are due once its lease ends.
+        deadline = sqlalchemy.func.coalesce(
+            models.PendingAction.lease_expiration,
+            models.PendingAction.timestamp)
+        return query.with_entities(deadline, models.PendingAction.id)
 
     # --------------------------------------------------------------------------
     # General Admin commands
     # --------------------------------------------------------------------------
 
     async def _admin_action(self, ctx, members, func):
-        results = await batch_do(members, func)
-        await ctx.send(f"Executed command: `{ctx.message.clean_content}`\n"
-                       + utils.format.vertical_list(results.values()),
-                       delete_after=DELETE_WAIT_DURATION)
+        members = list(members)
+        route = (ctx.command.qualified_name, ctx.guild.id)
+        command = ctx.message.clean_content
+        results = {}
+        status = None
+        last_update = time.monotonic()
+        async for member, result in batch_do(self.bulk, route, members, func):
+            results[member] = result
+            if len(results) >= len(members) or \
+               time.monotonic() - last_update < PROGRESS_UPDATE_INTERVAL:
+                continue
+            last_update = time.monotonic()
+            progress = (f"Executing command: `{command}`\n"
+                        f"Done: {len(results)}/{len(members)}")
+            if status is None:
+                status = await ctx.send(progress)
+            else:
+                await status.edit(content=progress)
+
+        content = format.ellipsize(
+            f"Executed command: `{command}`\n" +
+            format.vertical_list(results[member] for member in members))
+        if status is None:
+            await ctx.send(content, delete_after=DELETE_WAIT_DURATION)
+        else:
+            await status.edit(content=content,
+                              delete_after=DELETE_WAIT_DURATION)
 
     @commands.command(name="kick")
     @commands.guild_only()
@@ -3,8 +3,9 @@ import discord
 import logging
 import texttable
 from datetime import datetime
-from discord.ext import commands, tasks
+from discord.ext import commands
 from hourai import utils
+from hourai.bot import timers
 from hourai.db import escalation_history, models
 from hourai.utils import fake, checks, format
 
@@ -26,45 +27,59 @@ async def require_escalation_config(ctx):
 class EscalationMixin:
 
     def __init__(self, bot):
-        self.apply_pending_deescalations.start()
+        self.pending_deescalations = timers.DeadlineTimer(
+            self.load_pending_deescalations,
+            self.apply_pending_deescalations)
+        self.pending_deescalations.start(self.bot.wait_until_ready)
         super().__init__()
 
     def cog_unload(self):
-        self.apply_pending_deescalations.cancel()
+        self.pending_deescalations.cancel()
         super().cog_unload()
 
-    @tasks.loop(seconds=1)
-    async def apply_pending_deescalations(self):
+    @commands.Cog.listener()
+    async def on_deescalation_scheduled(self, expiration):
+        self.pending_deescalations.notify(expiration)
+
+    async def load_pending_deescalations(self, until):
+        def load(session):
+            query = self.__query_pending_deescalations(session, until)
+            return [(deesc.expiration, (deesc.user_id, deesc.guild_id))
+                    for deesc in query]
+        return await self.bot.storage.run_in_session(load)
+
+    async def apply_pending_deescalations(self, keys):
         try:
             session = self.bot.create_storage_session()
             with session:
-                for deesc in self.__query_pending_deescalations(session):
-                    await self.__apply_pending_deescalation(session, deesc)
+                # Reloaded in case they were rescheduled or removed since
+                # loading.
+                now = datetime.utcnow()
+                for key in keys:
+                    deesc = session.query(models.PendingDeescalation).get(key)
+                    if deesc is not None and deesc.expiration < now:
+                        await self.__apply_pending_deescalation(session,
+                                                                deesc)
         except Exception:
             log.exception('Error in running pending deescalation:')
 
     async def __apply_pending_deescalation(self, session, deesc):
         guild = self.bot.get_guild(deesc.guild_id)
         if guild is not None:
-            history = escalation_history.UwerEscalationHistory(
-                user=fake.FakeSnowflake(deesc.user_id),
+            history = escalation_history.UserEscalationHistory(
+                self.bot, user=fake.FakeSnowflake(deesc.user_id),
                 guild=guild, session=session)
             await history.apply_diff(guild.me, 'Automatic Deescalation',
                                      deesc.amount, execute=False)
         session.delete(deesc)
         session.commit()
 
-    def __query_pending_deescalations(self, session):
-        now = datetime.utcnow()
+    def __query_pending_deescalations(self, session, until):
         return session.query(models.PendingDeescalation) \
-                      .filter(models.PendingDeescalation.expiration < now) \
+                      .filter(models.PendingDeescalation.expiration < until) \
                       .order_by(models.PendingDeescalation.expiration) \
                       .all()
 
-    @apply_pending_deescalations.before_loop
-    async def before_apply_pending_deescalations(self):
-        await self.bot.wait_until_ready()
-
     @commands.group(name='escalate', invoke_without_command=True)
     @checks.is_moderator()
     @commands.check(require_escalation_config)
@@ -114,8 +114,7 @@ class Auto(cogs.BaseCog):
             await msg.delete()
 
     async def execute_actions(self, actions):
-        for action in actions:
-            await self.bot.actions.execute(action)
+        await self.bot.action_manager.sequentially_execute(actions)
 
     async def get_events(self, guild, event_type):
         config = await self.bot.get_guild_config(guild, 'auto')
@@ -1,9 +1,18 @@
 import asyncio
 import discord
+import time
 from discord.ext import commands, tasks
 from hourai.bot import cogs
 from hourai.utils import iterable
 
+# Seconds between syncs of each guild's bans. Bans and unbans in between are
+# saved from gateway events. Must be shorter than the expiration of stored
+# bans.
+SYNC_INTERVAL = 180
+# Seconds between rebuilds of the banned user filter, which drops users whose
+# bans expired and adds bans synced by other processes.
+FILTER_REBUILD_INTERVAL = SYNC_INTERVAL
+
 
 class BanLogging(cogs.BaseCog):
     """ Cog for logging guild bans. """
@@ -11,16 +20,33 @@ class BanLogging(cogs.BaseCog):
     def __init__(self, bot):
         super().__init__()
         self.bot = bot
+        # guild_id -> monotonic time the guild's bans last changed.
+        self.last_changed = {}
+        # guild_id -> monotonic time the guild's bans are next synced.
+        self.next_sync = {}
+        self.last_filter_rebuild = None
         self.reload_bans.start()
 
     def cog_unload(self):
         self.reload_bans.cancel()
 
-    @tasks.loop(seconds=180)
+    @tasks.loop(seconds=15)
     async def reload_bans(self):
-        for chunk in iterable.chunked(self.bot.guilds, chunk_size=5):
+        now = time.monotonic()
+        guilds = [guild for guild in self.bot.guilds
+                  if self.next_sync.get(guild.id, 0) <= now]
+        # Sync the most recently changed guilds first.
+        guilds.sort(key=lambda guild: self.last_changed.get(guild.id, 0),
+                    reverse=True)
+        for chunk in iterable.chunked(guilds, chunk_size=5):
             await asyncio.gather(*[
                 self.save_bans(guild) for guild in chunk])
+            await self.bot.storage.bans.flush_expirations()
+
+        if self.last_filter_rebuild is None or \
+           now - self.last_filter_rebuild >= FILTER_REBUILD_INTERVAL:
+            await self.bot.storage.bans.rebuild_filter()
+            self.last_filter_rebuild = now
 
     @reload_bans.before_loop
     async def before_reload_bans(self):
@@ -32,6 +58,8 @@ class BanLogging(cogs.BaseCog):
 
     @commands.Cog.listener()
     async def on_guild_remove(self, guild):
+        self.last_changed.pop(guild.id, None)
+        self.next_sync.pop(guild.id, None)
         await self.bot.storage.bans.clear_guild(guild.id)
 
     @commands.Cog.listener()
@@ -39,6 +67,7 @@ class BanLogging(cogs.BaseCog):
         await self.bot.wait_until_ready()
         if not guild.me.guild_permissions.ban_members:
             return
+        self.last_changed[guild.id] = time.monotonic()
         try:
             ban_info = await guild.fetch_ban(user)
             await self.bot.storage.bans.save_ban(guild, ban_info)
@@ -47,11 +76,15 @@ class BanLogging(cogs.BaseCog):
 
     @commands.Cog.listener()
     async def on_member_unban(self, guild, user):
+        self.last_changed[guild.id] = time.monotonic()
         await self.bot.storage.bans.clear_ban(guild, user)
 
     async def save_bans(self, guild):
+        now = time.monotonic()
         try:
-            await self.bot.storage.bans.save_bans(guild)
+            if await self.bot.storage.bans.save_bans(guild):
+                self.last_changed[guild.id] = now
         except Exception:
             self.bot.logger.exception(
                 f"Exception while reloading bans for guild {guild.id}:")
+        self.next_sync[guild.id] = now + SYNC_INTERVAL
@@ -1,8 +1,17 @@
+import asyncio
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from hourai.bot import cogs
 from hourai.db import models
 from hourai.utils import iterable
+from sqlalchemy import func, tuple_
+from sqlalchemy.dialects import postgresql
+
+# Seconds between batched writes of changed member roles.
+FLUSH_INTERVAL = 5
+# Number of pending members that triggers a write before the next interval.
+# Also the maximum number of rows written per statement.
+MAX_PENDING_ROLES = 1000
 
 
 class RoleLogging(cogs.BaseCog):
@@ -11,6 +20,21 @@ class RoleLogging(cogs.BaseCog):
     def __init__(self, bot):
         super().__init__()
         self.bot = bot
+        # (guild_id, user_id) -> latest role IDs waiting to be written.
+        self.pending = {}
+        self.flush_lock = asyncio.Lock()
+        self.flush_roles.start()
+
+    def cog_unload(self):
+        self.flush_roles.cancel()
+
+    @tasks.loop(seconds=FLUSH_INTERVAL)
+    async def flush_roles(self):
+        await self.flush()
+
+    @flush_roles.after_loop
+    async def after_flush_roles(self):
+        await self.flush()
 
     @commands.Cog.listener()
     async def on_member_join(self, member):
@@ -33,7 +57,7 @@ class RoleLogging(cogs.BaseCog):
 
     @commands.Cog.listener()
     async def on_guild_role_delete(self, role):
-        self.clear_role(role)
+        await self.clear_role(role)
 
     async def log_all_guilds(self):
         # FIXME: This will not scale to multiple processes/machines.
@@ -41,70 +65,84 @@ class RoleLogging(cogs.BaseCog):
             await self.log_guild_roles(guild)
 
     async def log_guild_roles(self, guild):
-        model = models.MemberRoles
         members = guild.fetch_members(limit=None)
         async for chunk in iterable.chunked_async(members, chunk_size=1000):
-            roles = {member.id: self.create_member_roles(member)
-                     for member in chunk if not member.bot}
-            with self.bot.create_storage_session() as session:
-                existing = session.query(model) \
-                                  .filter_by(guild_id=guild.id) \
-                                  .filter(model.user_id.in_(roles.keys())) \
-                                  .all()
-
-                for existing_roles in existing:
-                    # Only merge those posts which already exist in the
-                    # database
-                    session.merge(roles.pop(existing_roles.user_id))
-
-                # Only add those posts which did not exist in the database
-                # with roles
-                roles = {key: value for key, value in roles.items()
-                         if len(value.role_ids) > 0}
-                session.add_all(roles.values())
-                session.commit()
-                self._clear_empty(session)
-
-    def log_member_roles(self, member):
+            for member in chunk:
+                self.log_member_roles(member, flush=False)
+            await self.flush()
+
+    def log_member_roles(self, member, flush=True):
+        """Queues the member's current roles to be saved. Only the latest
+        roles of each member are kept until the next write. Members without
+        roles are removed from the database instead.
+        """
         if member.bot:
             return
-        member_roles = self.create_member_roles(member)
-        with self.bot.create_storage_session() as session:
-            id = (member.guild.id, member.id)
-            existing = session.query(models.MemberRoles).get(id)
-
-            if len(member_roles.role_ids) <= 0:
-                if existing:
-                    session.delete(existing)
-                else:
-                    return
-            else:
-                if existing:
-                    session.merge(member_roles)
-                else:
-                    session.add(member_roles)
-
-            session.commit()
-
-        self.bot.logger.info(
-            f'Updated roles for user {member.id}, guild {member.guild.id}')
-
-    def clear_role(self, role):
+        self.pending[(member.guild.id, member.id)] = tuple(member._roles)
+        if flush and len(self.pending) >= MAX_PENDING_ROLES and \
+           not self.flush_lock.locked():
+            self.bot.loop.create_task(self.flush())
+
+    async def flush(self):
+        """|coro| Writes all pending member roles in bulk.
+
+        Never raises: on failure, the batch is logged and requeued for the
+        next flush, so the flush loop keeps running.
+        """
+        async with self.flush_lock:
+            if len(self.pending) <= 0:
+                return
+            pending, self.pending = self.pending, {}
+            try:
+                await self.bot.storage.run_in_session(self._save_roles,
+                                                      pending)
+            except Exception:
+                self.bot.logger.exception(
+                    f'Failed to update roles for {len(pending)} members. '
+                    'Retrying on the next flush.')
+                # Requeue anything that has not been updated since.
+                pending.update(self.pending)
+                self.pending = pending
+                return
+        self.bot.logger.info(f'Updated roles for {len(pending)} members.')
+
+    async def clear_role(self, role):
         assert isinstance(role, discord.Role)
-        with self.bot.create_storage_session() as session:
-            session.execute(f"""
-            UPDATE member_roles
-            SET role_ids = array_remove(role_ids, {role.id})
-            WHERE guild_id = {role.guild.id}
-            """)
-            self._clear_empty(session)
-
-    def create_member_roles(self, member):
-        return models.MemberRoles(
-            guild_id=member.guild.id,
-            user_id=member.id,
-            role_ids=member._roles)
-
-    def _clear_empty(self, session):
-        session.execute(
-            "DELETE FROM member_roles WHERE cardinality(role_ids) = 0")
+        table = models.MemberRoles.__table__
+
+        def clear(session):
+            session.execute(
+                table.update()
+                     .where(table.c.guild_id == role.guild.id)
+                     .values(role_ids=func.array_remove(table.c.role_ids,
+                                                        role.id)))
+            session.execute(
+                table.delete()
+                     .where(table.c.guild_id == role.guild.id)
+                     .where(func.cardinality(table.c.role_ids) == 0))
+
+        async with self.flush_lock:
+            for key, role_ids in self.pending.items():
+                if key[0] == role.guild.id and role.id in role_ids:
+                    self.pending[key] = tuple(r for r in role_ids
+                                              if r != role.id)
+            await self.bot.storage.run_in_session(clear)
+
+    def _save_roles(self, session, pending):
+        table = models.MemberRoles.__table__
+        # Sorted to lock rows in a consistent order across writers.
+        items = sorted(pending.items())
+        upserts = [{'guild_id': guild_id, 'user_id': user_id,
+                    'role_ids': list(role_ids)}
+                   for (guild_id, user_id), role_ids in items
+                   if len(role_ids) > 0]
+        deletes = [key for key, role_ids in items if len(role_ids) <= 0]
+
+        for chunk in iterable.chunked(upserts, MAX_PENDING_ROLES):
+            insert = postgresql.insert(table).values(chunk)
+            session.execute(insert.on_conflict_do_update(
+                index_elements=[table.c.guild_id, table.c.user_id],
+                set_={'role_ids': insert.excluded.role_ids}))
+        for chunk in iterable.chunked(deletes, MAX_PENDING_ROLES):
+            session.execute(table.delete().where(
+                tuple_(table.c.guild_id, table.c.user_id).in_(chunk)))
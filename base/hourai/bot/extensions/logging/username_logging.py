@@ -1,14 +1,22 @@
 import asyncio
+import collections
 import logging
 import random
 from datetime import datetime
-from discord.ext import commands
+from discord.ext import commands, tasks
 from hourai.bot import cogs
-from hourai.utils import iterable
 from hourai.db.models import Username
 from sqlalchemy.exc import OperationalError
 
 MAX_STORED_USERNAMES = 20
+# Maximum number of users whose last seen username is kept in memory. Users
+# that are seen again with the same name skip the database entirely.
+SEEN_CACHE_SIZE = 250000
+# Seconds between batched writes of changed usernames.
+FLUSH_INTERVAL = 5
+# Number of pending changes that triggers a write before the next interval.
+# Also the maximum number of users written per transaction.
+MAX_PENDING_USERNAMES = 1000
 
 
 class UsernameLogging(cogs.BaseCog):
@@ -18,87 +26,149 @@ class UsernameLogging(cogs.BaseCog):
         super().__init__()
         self.bot = bot
         self.pending_ids = None
+        # user_id -> hash of the last name seen or logged for that user.
+        # Bounded to SEEN_CACHE_SIZE users. Dicts keep insertion order, and
+        # seen users are reinserted, so the least recently seen is evicted.
+        self.seen = {}
+        # user_id -> Username waiting to be written to the database.
+        self.pending = {}
+        self.flush_lock = asyncio.Lock()
+        self.flush_usernames.start()
+
+    def cog_unload(self):
+        self.flush_usernames.cancel()
+
+    @tasks.loop(seconds=FLUSH_INTERVAL)
+    async def flush_usernames(self):
+        await self.flush()
+
+    @flush_usernames.after_loop
+    async def after_flush_usernames(self):
+        await self.flush()
 
     @commands.Cog.listener()
     async def on_user_update(self, before, after):
         if before.name == after.name:
             return
         assert before.id == after.id
-        self.bot.loop.create_task(self.log_username_change(after))
+        self.log_username_change(after)
 
     @commands.Cog.listener()
     async def on_message(self, msg):
         if msg.webhook_id is not None:
             return
-        self.bot.loop.create_task(self.log_username_change(msg.author))
+        self.log_username_change(msg.author)
 
     @commands.Cog.listener()
     async def on_member_join(self, member):
-        self.bot.loop.create_task(self.log_username_change(member))
+        self.log_username_change(member)
 
     @commands.Cog.listener()
     async def on_member_remove(self, member):
-        self.bot.loop.create_task(self.log_username_change(member))
+        self.log_username_change(member)
 
     @commands.Cog.listener()
     async def on_member_ban(self, guild, user):
-        self.bot.loop.create_task(self.log_username_change(user))
+        self.log_username_change(user)
 
     @commands.Cog.listener()
     async def on_member_unban(self, guild, user):
-        self.bot.loop.create_task(self.log_username_change(user))
+        self.log_username_change(user)
 
     @commands.Cog.listener()
     async def on_group_join(self, group, user):
-        self.bot.loop.create_task(self.log_username_change(user))
+        self.log_username_change(user)
 
     @commands.Cog.listener()
     async def on_group_remove(self, group, user):
-        self.bot.loop.create_task(self.log_username_change(user))
+        self.log_username_change(user)
 
     @commands.Cog.listener()
     async def on_guild_join(self, guild):
-        members = guild.fetch_members(limit=None)
-        async for chunk in iterable.chunked_async(members, chunk_size=10):
-            await asyncio.gather(
-                *[self.log_username_change(user) for user in chunk])
+        async for member in guild.fetch_members(limit=None):
+            self.log_username_change(member)
+        await self.flush()
 
     @commands.command()
     @commands.is_owner()
     async def refresh(self, ctx):
         async with ctx.typing():
-            async for chunk in iterable.chunked(ctx.bot.users, chunk_size=10):
-                await asyncio.gather(
-                    *[self.log_username_change(user) for user in chunk])
+            for user in ctx.bot.users:
+                self.log_username_change(user)
+            await self.flush()
         await ctx.send(':thumbsup:')
 
-    async def log_username_change(self, user):
+    def log_username_change(self, user):
+        """Queues the user's current name to be logged. Names that were
+        already seen for the user are skipped without touching the database.
+        """
         # Don't log system or webhook accounts
         if int(user.discriminator) == 0:
             return
 
-        timestamp = datetime.utcnow()
+        name_hash = hash(user.name)
+        if self.seen.pop(user.id, None) == name_hash:
+            self.seen[user.id] = name_hash
+            return
+        self.seen[user.id] = name_hash
+        if len(self.seen) > SEEN_CACHE_SIZE:
+            del self.seen[next(iter(self.seen))]
+        self.pending[user.id] = Username(user_id=user.id, name=user.name,
+                                         timestamp=datetime.utcnow(),
+                                         discriminator=user.discriminator)
+        if len(self.pending) >= MAX_PENDING_USERNAMES and \
+           not self.flush_lock.locked():
+            self.bot.loop.create_task(self.flush())
+
+    async def flush(self):
+        """|coro| Writes all pending username changes, in transactions of at
+        most MAX_PENDING_USERNAMES users.
+
+        Never raises: on failure, the unwritten changes are logged and
+        requeued for the next flush, so the flush loop keeps running.
+        """
+        async with self.flush_lock:
+            if len(self.pending) <= 0:
+                return
+            pending, self.pending = self.pending, {}
+            items = list(pending.items())
+            for start in range(0, len(items), MAX_PENDING_USERNAMES):
+                chunk = items[start:start + MAX_PENDING_USERNAMES]
+                try:
+                    await self.__write_usernames(dict(chunk))
+                except Exception:
+                    unwritten = dict(items[start:])
+                    self.bot.logger.exception(
+                        f'Failed to log {len(unwritten)} usernames. Retrying '
+                        'on the next flush.')
+                    # Requeue anything that has not been updated since.
+                    unwritten.update(self.pending)
+                    self.pending = unwritten
+                    return
+
+    async def __write_usernames(self, pending):
+        def log_usernames(session):
+            histories = collections.defaultdict(list)
+            query = session.query(Username) \
+                           .filter(Username.user_id.in_(list(pending)))
+            for username in query:
+                histories[username.user_id].append(username)
+            for user_id, username in pending.items():
+                usernames = histories[user_id]
+                if any(n.name == username.name for n in usernames):
+                    continue
+                usernames.append(username)
+                filtered = self.merge_names(usernames, session)
+                if username in filtered:
+                    session.add(username)
+            self.log_changes(session)
+            session.commit()
 
         logged = False
         backoff = 1
         while not logged:
             try:
-                with self.bot.create_storage_session() as session:
-                    usernames = session.query(Username) \
-                                       .filter_by(user_id=user.id) \
-                                       .order_by(Username.timestamp.desc())
-                    usernames = list(usernames)
-                    if any(n.name == user.name for n in usernames):
-                        return
-                    username = Username(user_id=user.id, name=user.name,
-                                        timestamp=timestamp,
-                                        discriminator=user.discriminator)
-                    usernames.append(username)
-                    filtered = self.merge_names(usernames, session)
-                    if username in filtered:
-                        session.add(username)
-                    self.log_changes(session)
-                    session.commit()
+                await self.bot.storage.run_in_session(log_usernames)
                 logged = True
             except OperationalError:
                 msg = f'OperationalError: Retrying in {backoff} seconds.'
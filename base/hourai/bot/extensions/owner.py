@@ -210,6 +210,71 @@ class Owner(cogs.BaseCog):
         output = await hastebin.str_or_hastebin_link(ctx.bot, table.draw())
         await ctx.send(format.multiline_code(output))
 
+    @commands.command()
+    async def caches(self, ctx):
+        """Provides debug information about the bot's local caches."""
+        columns = ('Cache', 'Size', 'Max Size', 'Hits', 'Misses', 'Hit Rate',
+                   'Expired', 'Evicted')
+        table = texttable.Texttable()
+        table.set_deco(texttable.Texttable.HEADER | texttable.Texttable.VLINES)
+        table.set_cols_align(["r"] * len(columns))
+        table.set_cols_valign(["t"] + ["i"] * (len(columns) - 1))
+        table.header(columns)
+        for name, stats in sorted(ctx.bot.storage.cache_stats().items()):
+            lookups = stats['hits'] + stats['misses']
+            hit_rate = stats['hits'] / lookups if lookups else "N/A"
+            table.add_row([name, stats['size'], stats['max_size'],
+                           stats['hits'], stats['misses'], hit_rate,
+                           stats['expired'], stats['evicted']])
+
+        output = await hastebin.str_or_hastebin_link(ctx.bot, table.draw())
+        await ctx.send(format.multiline_code(output))
+
+    @commands.command()
+    async def sqlpool(self, ctx):
+        """Provides debug information about the SQL connection pool."""
+        stats = ctx.bot.storage.sql_pool_stats()
+        if stats is None:
+            await ctx.send('SQL connection pool is not instrumented.')
+            return
+        checkouts = stats['checkouts']
+        avg_wait = stats['checkout_wait'] / checkouts if checkouts else "N/A"
+        output = [
+            f'Size: {stats["size"]}',
+            f'In Use: {stats["in_use"]}',
+            f'Overflow: {stats["overflow"]}',
+            f'Checkouts: {checkouts}',
+            f'Timeouts: {stats["timeouts"]}',
+            f'Total Checkout Wait: {stats["checkout_wait"]}',
+            f'Average Checkout Wait: {avg_wait}',
+        ]
+        await ctx.send(format.multiline_code(format.vertical_list(output)))
+
+    @commands.command()
+    async def banfilter(self, ctx):
+        """Provides debug information about the banned user filter."""
+        stats = ctx.bot.storage.bans.filter_stats()
+        if stats is None:
+            await ctx.send('Banned user filter has not been built yet.')
+            return
+        lookups = stats['negatives'] + stats['positives']
+        skip_rate = stats['negatives'] / lookups if lookups else "N/A"
+        fp_rate = (stats['false_positives'] /
+                   (stats['false_positives'] + stats['negatives'])
+                   if stats['false_positives'] + stats['negatives'] else
+                   "N/A")
+        output = [
+            f'Items: {stats["items"]}',
+            f'Capacity: {stats["capacity"]}',
+            f'Size: {stats["size_bytes"]} bytes',
+            f'Expected False Positive Rate: {stats["expected_fp_rate"]}',
+            f'Observed False Positive Rate: {fp_rate}',
+            f'Lookups: {lookups}',
+            f'Skipped Lookups: {stats["negatives"]} ({skip_rate})',
+            f'Rebuilds: {stats["rebuilds"]}',
+        ]
+        await ctx.send(format.multiline_code(format.vertical_list(output)))
+
     @commands.command()
     async def stats(self, ctx):
         """Provides statistics for each shard of the bot."""
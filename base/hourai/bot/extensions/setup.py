@@ -26,16 +26,15 @@ class Setup(cogs.BaseCog):
 
     @commands.Cog.listener()
     async def on_guild_join(self, guild):
-        with self.bot.create_storage_session() as session:
-            config = session.query(models.AdminConfig).get(guild.id)
-            if config is not None and config.is_blocked:
-                await guild.leave()
-                return
+        config = await self.bot.storage.admin_configs.get(guild.id)
+        if config is not None and config.is_blocked:
+            await guild.leave()
+            return
 
-            tasks = [self.__setup_modlog(session, guild)]
-            await asyncio.gather(*tasks)
+        tasks = [self.__setup_modlog(guild)]
+        await asyncio.gather(*tasks)
 
-    async def __setup_modlog(self, session, guild):
+    async def __setup_modlog(self, guild):
         proxy = self.bot.get_guild_proxy(guild)
         config = await proxy.config.get('logging')
 
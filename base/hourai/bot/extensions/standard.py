@@ -270,7 +270,7 @@ class Standard(cogs.BaseCog):
     @commands.command()
     async def whois(self, ctx, user: typing.Union[discord.Member,
                                                   discord.User]):
-        await ctx.send(embed=embed.make_whois_embed(ctx, user))
+        await ctx.send(embed=await embed.make_whois_embed(ctx, user))
 
 
 def setup(bot):
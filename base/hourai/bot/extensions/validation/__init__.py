@@ -145,6 +145,10 @@ VALIDATORS = (
     approvers.BotOwnerApprover(),
 )
 
+# Validators with per-guild name indexes, kept up to date from member events.
+NAME_MATCH_REJECTORS = tuple(v for v in VALIDATORS
+                             if isinstance(v, rejectors.NameMatchRejector))
+
 
 class Validation(cogs.BaseCog):
 
@@ -158,6 +162,46 @@ class Validation(cogs.BaseCog):
             return
         await self.bot.get_guild_proxy(guild).invites.refresh()
 
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        for rejector in NAME_MATCH_REJECTORS:
+            rejector.remove_guild(guild)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before, after):
+        if before.nick == after.nick and before.roles == after.roles:
+            return
+        for rejector in NAME_MATCH_REJECTORS:
+            rejector.update_member(after)
+
+    @commands.Cog.listener()
+    async def on_user_update(self, before, after):
+        if before.name == after.name:
+            return
+        for rejector in NAME_MATCH_REJECTORS:
+            rejector.update_user(after)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        for rejector in NAME_MATCH_REJECTORS:
+            rejector.remove_member(member)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before, after):
+        if utils.is_moderator_role(before) == utils.is_moderator_role(after):
+            return
+        # Rare, so the indexes are rebuilt instead of updating every member
+        # with the role.
+        for rejector in NAME_MATCH_REJECTORS:
+            rejector.remove_guild(after.guild)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role):
+        if not utils.is_moderator_role(role):
+            return
+        for rejector in NAME_MATCH_REJECTORS:
+            rejector.remove_guild(role.guild)
+
     @commands.Cog.listener()
     async def on_invite_create(self, invite):
         self.bot.get_guild_proxy(invite.guild).invites.add(invite)
@@ -378,6 +422,9 @@ class Validation(cogs.BaseCog):
 
     @commands.Cog.listener()
     async def on_member_join(self, member):
+        for rejector in NAME_MATCH_REJECTORS:
+            rejector.update_member(member)
+
         config = await self.bot.get_guild_config(member.guild, 'validation')
         if config is None or not config.enabled:
             return
@@ -491,12 +538,10 @@ class Validation(cogs.BaseCog):
 
     async def report_bans(self, ban_info):
         user = ban_info.user
-        # FIXME(james7132): This will not scale to multiple processes/nodes.
-        members = await asyncio.gather(
-                *[utils.get_member_async(guild, user.id)
-                  for guild in self.bot.guilds])
-        guild_proxies = [self.bot.get_guild_proxy(member.guild)
-                         for member in members if member is not None]
+        guild_ids = self.bot.storage.member_index.get_guild_ids(user.id)
+        guilds = (self.bot.get_guild(guild_id) for guild_id in guild_ids)
+        guild_proxies = [self.bot.get_guild_proxy(guild)
+                         for guild in guilds if guild is not None]
 
         contents = None
         if ban_info.reason is None:
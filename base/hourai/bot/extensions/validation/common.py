@@ -10,13 +10,19 @@ class Validator():
 
 
 def split_camel_case(val):
-    return re.sub('([a-z])([A-Z0-9])', '$1 $2', val).split()
+    return re.sub('([a-z])([A-Z0-9])', r'\1 \2', val).split()
 
 
 def generalize_filter(filter_value):
+    return '(?i)' + generalize_pattern(filter_value)
+
+
+def generalize_pattern(filter_value):
+    """Same as generalize_filter, without the case insensitivity flag. Can be
+    combined with other patterns.
+    """
     filter_value = re.escape(filter_value)
 
     def _generalize_character(char):
         return char + '+' if char.isalnum() else char
-    generalized = (_generalize_character(char) for char in filter_value)
-    return '(?i)' + ''.join(generalized)
+    return ''.join(_generalize_character(char) for char in filter_value)
@@ -38,22 +38,31 @@ class ValidationContext:
 
     @property
     def usernames(self):
-        if self._usernames is None:
-            names = set()
-            if self.member.name is not None:
-                names.add(Username(
-                    name=self.member.name,
-                    discriminator=self.member.discriminator,
-                    timestamp=datetime.utcnow()))
-            with self.bot.create_storage_session() as session:
-                usernames = session.query(models.Username) \
-                                   .filter_by(user_id=self.member.id) \
-                                   .all()
-                names.update([Username(name=u.name,
-                                       discriminator=u.discriminator,
-                                       timestamp=u.timestamp)
-                              for u in usernames])
-            self._usernames = names
+        """The current and historical usernames of the member. Must be loaded
+        with fetch_usernames first.
+        """
+        assert self._usernames is not None
+        return self._usernames
+
+    async def fetch_usernames(self):
+        if self._usernames is not None:
+            return self._usernames
+
+        def query(session):
+            usernames = session.query(models.Username) \
+                               .filter_by(user_id=self.member.id) \
+                               .all()
+            return [Username(name=u.name, discriminator=u.discriminator,
+                             timestamp=u.timestamp)
+                    for u in usernames]
+
+        names = set(await self.bot.storage.run_in_session(query))
+        if self.member.name is not None:
+            names.add(Username(
+                name=self.member.name,
+                discriminator=self.member.discriminator,
+                timestamp=datetime.utcnow()))
+        self._usernames = names
         return self._usernames
 
     def add_approval_reason(self, reason):
@@ -90,6 +99,7 @@ class ValidationContext:
                     f' permissions to give them the role')
 
     async def validate_member(self, validators):
+        await self.fetch_usernames()
         for validator in validators:
             try:
                 await validator.validate_member(self)
@@ -148,4 +158,4 @@ class ValidationContext:
         async with ctx:
             return await messageable.send(
                 content="\n".join(message),
-                embed= embed.make_whois_embed(ctx, member))
+                embed=await embed.make_whois_embed(ctx, member))
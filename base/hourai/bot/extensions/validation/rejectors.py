@@ -1,22 +1,88 @@
+import collections
 import humanize
 import re
 from unidecode import unidecode
 from datetime import datetime
 from hourai import utils
 from hourai.db import models
-from .common import Validator, generalize_filter, split_camel_case
+from .common import (Validator, generalize_filter, generalize_pattern,
+                     split_camel_case)
 
 
 LOOSE_DELETED_USERNAME_MATCH = re.compile(r'(?i).*Deleted.*User.*')
 TRANSFORMS = (lambda x: x, unidecode)
 
 
+class NameIndex:
+    """Name fragments of some of the members of a guild, and the members they
+    came from. All fragments are compiled into a single regex, which finds
+    names that match none of them in a single pass.
+    """
+    __slots__ = ("guild", "_fragments", "_counts", "_patterns", "_matcher")
+
+    def __init__(self, guild):
+        self.guild = guild
+        # Member ID -> frozenset of name fragments.
+        self._fragments = {}
+        # Name fragment -> number of members with it.
+        self._counts = collections.Counter()
+        # Name fragment -> compiled pattern. Only used when the matcher hits.
+        self._patterns = {}
+        # Rebuilt lazily when the set of fragments changes.
+        self._matcher = None
+
+    def __contains__(self, member_id):
+        return member_id in self._fragments
+
+    def update(self, member_id, fragments):
+        fragments = frozenset(fragments)
+        old = self._fragments.pop(member_id, frozenset())
+        if len(fragments) > 0:
+            self._fragments[member_id] = fragments
+        if fragments == old:
+            return
+        for fragment in old - fragments:
+            self._counts[fragment] -= 1
+            if self._counts[fragment] <= 0:
+                del self._counts[fragment]
+                self._patterns.pop(fragment, None)
+                self._matcher = None
+        for fragment in fragments - old:
+            if fragment not in self._counts:
+                self._matcher = None
+            self._counts[fragment] += 1
+
+    def search(self, value):
+        """Gets every fragment that matches somewhere in value."""
+        if len(self._counts) <= 0:
+            return []
+        if self._matcher is None:
+            pattern = '|'.join(f'(?:{generalize_pattern(f)})'
+                               for f in self._counts)
+            self._matcher = re.compile(pattern, re.IGNORECASE)
+        if self._matcher.search(value) is None:
+            return []
+        return [fragment for fragment in self._counts
+                if self.__get_pattern(fragment).search(value)]
+
+    def __get_pattern(self, fragment):
+        pattern = self._patterns.get(fragment)
+        if pattern is None:
+            pattern = re.compile(generalize_filter(fragment))
+            self._patterns[fragment] = pattern
+        return pattern
+
+
 class NameMatchRejector(Validator):
     """A suspicion level validator that rejects users for username proximity to
     other users already on the server.
+
+    The names of matching members are kept in a NameIndex per guild, built on
+    the first validation in the guild and kept up to date by the
+    update_member, update_user, remove_member, and remove_guild events.
     """
     __slots__ = ("filter", "prefix", "subfield", "member_selector",
-                 "min_match_length")
+                 "min_match_length", "_indexes")
 
     def __init__(self, *, prefix, filter_func,
                  min_match_length=None, subfield=None, member_selector=None):
@@ -25,19 +91,51 @@ class NameMatchRejector(Validator):
         self.subfield = subfield or (lambda m: m.name)
         self.member_selector = member_selector or (lambda m: m.name)
         self.min_match_length = min_match_length
+        self._indexes = {}
 
     async def validate_member(self, ctx):
-        member_names = {}
-        for guild_member in filter(self.filter, ctx.guild.members):
-            name = self.member_selector(guild_member) or ''
-            member_names.update({
-                p: generalize_filter(p) for p in self._split_name(name)
-            })
         field_value = self.subfield(ctx.member)
-        for filter_name, regex in member_names.items():
-            if re.search(regex, field_value):
-                ctx.add_rejection_reason(
-                    self.prefix + f'Matches: `{filter_name}`')
+        for filter_name in self.get_index(ctx.guild).search(field_value):
+            ctx.add_rejection_reason(
+                self.prefix + f'Matches: `{filter_name}`')
+
+    def get_index(self, guild):
+        index = self._indexes.get(guild.id)
+        if index is None:
+            index = NameIndex(guild)
+            for member in filter(self.filter, guild.members):
+                index.update(member.id, self._get_fragments(member))
+            self._indexes[guild.id] = index
+        return index
+
+    def update_member(self, member):
+        index = self._indexes.get(member.guild.id)
+        if index is None:
+            return
+        fragments = self._get_fragments(member) if self.filter(member) else ()
+        index.update(member.id, fragments)
+
+    def update_user(self, user):
+        for index in self._indexes.values():
+            if user.id not in index:
+                continue
+            member = index.guild.get_member(user.id)
+            if member is not None:
+                self.update_member(member)
+
+    def remove_member(self, member):
+        index = self._indexes.get(member.guild.id)
+        if index is not None:
+            index.update(member.id, ())
+
+    def remove_guild(self, guild):
+        """Drops the index of a guild. It is rebuilt on the next validation
+        in the guild.
+        """
+        self._indexes.pop(guild.id, None)
+
+    def _get_fragments(self, member):
+        return self._split_name(self.member_selector(member) or '')
 
     def _split_name(self, name):
         split_name = split_camel_case(name)
@@ -168,7 +266,7 @@ class BannedUsernameRejector(Validator):
         if not ctx.guild.me.guild_permissions.ban_members:
             return
         bans = await ctx.bot.storage.bans.get_guild_bans(ctx.guild.id)
-        self.__check_usernames(ctx, bans)
+        await self.__check_usernames(ctx, bans)
         self.__check_avatars(ctx, bans)
 
     def __check_avatars(self, ctx, bans):
@@ -184,35 +282,38 @@ class BannedUsernameRejector(Validator):
                 reason += f" Ban Reason: {ban.reason}"
             ctx.add_rejection_reason(reason)
 
-    def __check_usernames(self, ctx, bans):
+    async def __check_usernames(self, ctx, bans):
         ban_ids = [ban.user_id for ban in bans]
         ban_reasons = {ban.user_id:
                        ban.reason if ban.HasField('reason') else None
                        for ban in bans}
-        with ctx.bot.create_storage_session() as session:
-            matches = session.query(models.Username) \
-                             .filter(models.Username.user_id.in_(ban_ids)) \
-                             .distinct(models.Username.name)
-
-            for transform in TRANSFORMS:
-                normalized_usernames = set(self._normalize(transform(u.name))
-                                           for u in ctx.usernames)
-                # Don't match on empty string matches
-                normalized_usernames.discard("")
-
-                for banned_username in matches.all():
-                    transformed = transform(banned_username.name)
-                    normalized = self._normalize(transformed)
-                    if not normalized in normalized_usernames:
-                        continue
-                    ban_reason = ban_reasons.get(banned_username.user_id)
-                    reason = (f"Exact username match with banned user: "
-                              f"{banned_username.name} "
-                              f"({banned_username.user_id}).")
-                    if ban_reason is not None:
-                        reason += f" Ban Reason: {ban_reason}"
-                    ctx.add_rejection_reason(reason)
-                    break
+
+        def query(session):
+            return session.query(models.Username) \
+                          .filter(models.Username.user_id.in_(ban_ids)) \
+                          .distinct(models.Username.name) \
+                          .all()
+        matches = await ctx.bot.storage.run_in_session(query)
+
+        for transform in TRANSFORMS:
+            normalized_usernames = set(self._normalize(transform(u.name))
+                                       for u in ctx.usernames)
+            # Don't match on empty string matches
+            normalized_usernames.discard("")
+
+            for banned_username in matches:
+                transformed = transform(banned_username.name)
+                normalized = self._normalize(transformed)
+                if not normalized in normalized_usernames:
+                    continue
+                ban_reason = ban_reasons.get(banned_username.user_id)
+                reason = (f"Exact username match with banned user: "
+                          f"{banned_username.name} "
+                          f"({banned_username.user_id}).")
+                if ban_reason is not None:
+                    reason += f" Ban Reason: {ban_reason}"
+                ctx.add_rejection_reason(reason)
+                break
 
     def _normalize(self, val):
         return " ".join(val.casefold().split())
@@ -0,0 +1,120 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from datetime import datetime, timedelta
+
+log = logging.getLogger(__name__)
+
+# How far ahead deadlines are loaded from the database at a time.
+DEFAULT_WINDOW = timedelta(minutes=5)
+
+
+class DeadlineTimer:
+    """Runs persisted items when their deadlines pass, without polling.
+
+    Loads every item due before the end of the current window with
+    load(until), keeps them in a min-heap, and sleeps until the earliest
+    deadline or the end of the window, whichever is first. Due items are
+    passed to run(items) in deadline order. The database is only queried
+    again at the end of each window, or when notify reports an item added
+    within the current one.
+
+    load(until) must return an iterable of (deadline, item) pairs, including
+    those already overdue. run(items) must remove the items from the backing
+    store, or they are loaded and run again. Deadlines are naive UTC
+    datetimes.
+    """
+
+    def __init__(self, load, run, *, window=DEFAULT_WINDOW, name=None):
+        self.load = load
+        self.run = run
+        self.window = window
+        self.name = name or run.__name__
+        self._heap = []
+        # Sequence numbers break ties so items are never compared.
+        self._counter = itertools.count()
+        self._window_end = None
+        # Set when items may have been added to the current window since it
+        # was loaded.
+        self._stale = True
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self, wait_for=None):
+        """Starts running items. If provided, the coroutine function wait_for
+        is awaited before the first load.
+        """
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run_forever(wait_for))
+
+    def cancel(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def notify(self, deadline):
+        """Reports that an item with the given deadline was added to the
+        backing store. Reloads immediately if it falls in the current window,
+        or once the window being loaded is done if it may fall in it.
+        """
+        if self._window_end is None or deadline < self._window_end:
+            self._stale = True
+            self._wakeup.set()
+
+    def push(self, deadline, item):
+        """Adds an item to run at the given deadline without reloading. Used
+        to retry items that run could not remove from the backing store.
+        The item is dropped by the next reload if it is no longer due by
+        then.
+        """
+        heapq.heappush(self._heap, (deadline, next(self._counter), item))
+        self._wakeup.set()
+
+    async def _run_forever(self, wait_for):
+        if wait_for is not None:
+            await wait_for()
+        while True:
+            try:
+                await self._tick()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception(f'Error in running {self.name}:')
+                self._stale = True
+                await asyncio.sleep(1)
+
+    async def _tick(self):
+        now = datetime.utcnow()
+        if self._stale or now >= self._window_end:
+            await self._reload(now)
+
+        due = []
+        while self._heap and self._heap[0][0] < now:
+            due.append(heapq.heappop(self._heap)[2])
+        if len(due) > 0:
+            await self.run(due)
+
+        next_deadline = self._window_end
+        if self._heap:
+            next_deadline = min(next_deadline, self._heap[0][0])
+        delay = (next_deadline - datetime.utcnow()).total_seconds()
+        self._wakeup.clear()
+        # Wakeups from notifications during the load or run were just
+        # cleared, but they also marked the window stale.
+        if delay > 0 and not self._stale:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _reload(self, now):
+        window_end = now + self.window
+        # Any notification until the load finishes may be in the new window.
+        self._window_end = None
+        self._stale = False
+        items = await self.load(window_end)
+        self._heap = [(deadline, next(self._counter), item)
+                      for deadline, item in items]
+        heapq.heapify(self._heap)
+        self._window_end = window_end
@@ -95,7 +95,23 @@ def __make_configuration_template():
         "command_prefix": "",
 
         "database": "",
+        "database_pool": {
+            "size": 0,
+            "max_overflow": 0,
+            "timeout": 0,
+            "recycle": 0,
+            "pre_ping": False,
+        },
         "redis": "",
+        "compression_dictionary": "",
+        "share_member_index": False,
+
+        "bulk_actions": {
+            "concurrency": 0,
+            "route_rate": 0,
+            "route_period": 0,
+            "max_interactive_size": 0,
+        },
 
         "activity": "",
 
@@ -0,0 +1,118 @@
+import asyncio
+import coders
+import logging
+import time
+from . import models
+
+log = logging.getLogger(__name__)
+
+# Seconds after which the local table is reloaded from the database. Catches
+# changes made directly to the database instead of through the table.
+DEFAULT_RELOAD_TTL = 10 * 60
+
+
+class AdminConfigTable:
+    """An in-process copy of the admin_configs table.
+
+    The table only has rows for the few guilds with administrative overrides,
+    so it is loaded from the database in full with a single query and lookups
+    are served from memory afterwards. Writes made through this table are
+    broadcast through the invalidator, if provided, which makes every other
+    process reload it on its next lookup.
+
+    Returned configs are detached from their session and must not be modified.
+    """
+
+    NAME = 'admin_configs'
+
+    def __init__(self, storage, *, invalidator=None,
+                 reload_ttl=DEFAULT_RELOAD_TTL):
+        self.storage = storage
+        self.invalidator = invalidator
+        self.reload_ttl = reload_ttl
+        self._configs = None
+        self._loaded_at = None
+        self._load_lock = asyncio.Lock()
+        # Incremented on every local invalidation. Used to avoid keeping a
+        # table loaded before a concurrent invalidation.
+        self._generation = 0
+        self._key_coder = coders.IntCoder()
+
+        if invalidator is not None:
+            invalidator.register(self.NAME, self)
+
+    async def get(self, guild_id):
+        """|coro| Gets the AdminConfig for a guild, or None if it has none."""
+        configs = await self._get_configs()
+        return configs.get(guild_id)
+
+    async def get_all(self, guild_ids):
+        """|coro| Gets the AdminConfigs for multiple guilds. Returns a dict
+        mapping every guild ID to its AdminConfig, or None if it has none.
+        """
+        configs = await self._get_configs()
+        return {guild_id: configs.get(guild_id) for guild_id in guild_ids}
+
+    async def is_source_blocked(self, guild_id):
+        """|coro| Checks if bans from a guild are not to be shared with other
+        guilds.
+        """
+        config = await self.get(guild_id)
+        return config is not None and not config.source_bans
+
+    async def set(self, config):
+        """|coro| Saves an AdminConfig to the database and invalidates every
+        copy of the table.
+        """
+        def save(session):
+            session.merge(config)
+        await self.storage.run_in_session(save)
+        await self._invalidate(config.id)
+
+    async def clear(self, guild_id):
+        """|coro| Deletes the AdminConfig of a guild from the database and
+        invalidates every copy of the table.
+        """
+        def delete(session):
+            session.query(models.AdminConfig) \
+                   .filter_by(id=guild_id) \
+                   .delete()
+        await self.storage.run_in_session(delete)
+        await self._invalidate(guild_id)
+
+    def invalidate_local(self, key):
+        """Drops the local copy of the table. Called by the invalidator."""
+        self.flush_local()
+
+    def flush_local(self):
+        """Drops the local copy of the table."""
+        self._generation += 1
+        self._configs = None
+
+    async def _invalidate(self, guild_id):
+        self.flush_local()
+        if self.invalidator is not None:
+            await self.invalidator.publish(
+                self.NAME, [self._key_coder.encode(guild_id)])
+
+    async def _get_configs(self):
+        configs = self._configs
+        if configs is not None and \
+           time.monotonic() - self._loaded_at < self.reload_ttl:
+            return configs
+        async with self._load_lock:
+            # Another lookup may have loaded it while waiting on the lock.
+            if self._configs is not None and \
+               time.monotonic() - self._loaded_at < self.reload_ttl:
+                return self._configs
+            generation = self._generation
+
+            def load(session):
+                return {config.id: config
+                        for config in session.query(models.AdminConfig)}
+            configs = await self.storage.run_in_session(load)
+            if generation == self._generation:
+                self._configs = configs
+                self._loaded_at = time.monotonic()
+            log.debug(f'Loaded {len(configs)} admin configs.')
+            return configs
@@ -1,8 +1,10 @@
 import collections
+import hashlib
 import logging
 import coders
-from . import proto, models
-from .redis_utils import redis_transaction
+from . import bloom, proto
+from .redis_utils import (redis_expire_all, redis_transaction,
+                          redis_watch_transaction)
 from hourai.utils import iterable
 
 log = logging.getLogger(__name__)
@@ -11,7 +13,14 @@ BanEntry = collections.namedtuple('BanEntry', 'guild_id user_id avatar reason')
 
 GUILD_BAN_PREFIX = 0
 USER_BAN_PREFIX = 1
+GUILD_FINGERPRINT_PREFIX = 2
 MAX_CHUNK_SIZE = 1024
+# Maximum number of keys whose expiration is refreshed in a single command.
+MAX_EXPIRE_BATCH_SIZE = 10000
+# Minimum number of users the banned user filter is sized for. The filter is
+# sized for twice the number of banned users seen at the last rebuild.
+MIN_FILTER_CAPACITY = 100000
+FILTER_ERROR_RATE = 0.01
 
 
 def _get_guild_size(guild):
@@ -22,72 +31,332 @@ def _get_guild_size(guild):
 
 
 class BanStorage:
-    """An interface for access store all of the bans seen by the bot."""
-
-    def __init__(self, storage, prefix, timeout=300):
+    """An interface for access store all of the bans seen by the bot.
+
+    Keeps a counting Bloom filter of every banned user, which answers most
+    get_user_bans calls for users that are not banned without touching Redis.
+    The filter of each process counts the users it saw go from banned nowhere
+    to banned somewhere. If an invalidator is provided, those users are
+    broadcast to the filters of every other process. Without one, or if a
+    broadcast is missed, bans saved by other processes are not found by
+    get_user_bans until the next rebuild_filter. Users are only removed from
+    the filter of the process that saw their last ban cleared, so other
+    processes keep answering with harmless false positives until they
+    rebuild.
+    """
+
+    NAME = 'banned_users'
+
+    def __init__(self, storage, prefix, timeout=300, *, invalidator=None):
         self.storage = storage
         self.timeout = timeout
+        self.invalidator = invalidator
 
         guild_prefix = bytes([prefix, GUILD_BAN_PREFIX])
         user_prefix = bytes([prefix, USER_BAN_PREFIX])
+        self._user_prefix = user_prefix
 
         self._guild_key_coder = coders.IntCoder().prefixed(guild_prefix)
         self._user_key_coder = coders.IntCoder().prefixed(user_prefix)
+        self._fingerprint_key_coder = coders.IntCoder().prefixed(
+            bytes([prefix, GUILD_FINGERPRINT_PREFIX]))
 
         self._guild_value_coder = coders.ProtobufCoder(proto.BanInfo) \
-                                        .compressed()
+                                        .then(storage.compression_coder)
         self._id_coder = coders.IntCoder()
+        # Keys that need their expiration refreshed, grouped by key prefix.
+        self._pending_expirations = collections.defaultdict(set)
+        # guild_id -> the set of encoded IDs of users banned or unbanned during
+        # each running save_bans of the guild.
+        self._changed_during_sync = collections.defaultdict(list)
+
+        # Filter of every banned user ID. Users not in it are known to not be
+        # banned anywhere. None until first built by rebuild_filter.
+        self.banned_users = None
+        self._building_filter = None
+        self.filter_counters = collections.Counter()
+
+        if invalidator is not None:
+            invalidator.register(self.NAME, self)
 
     @property
     def redis(self):
         return self.storage.redis
 
-    def is_guild_blocked(self, guild):
-        session = self.storage.create_session()
-        with session:
-            config = session.query(models.AdminConfig).get(guild.id)
-            return config is not None and not config.source_bans
+    async def is_guild_blocked(self, guild):
+        return await self.storage.admin_configs.is_source_blocked(guild.id)
 
     async def save_bans(self, guild):
-        """Atomically saves all of the bans for a given guild to the backng
-        store.
+        """Syncs the stored bans for a given guild with its current bans.
+
+        Does nothing but queue an expiration refresh if the fingerprint of the
+        bans is unchanged since the last sync. Otherwise only the bans that
+        were added, removed or changed are written. Call flush_expirations
+        afterwards to refresh the expiration of the guild's keys.
+
+        Users banned or unbanned through save_ban or clear_ban while the sync
+        runs are left as those wrote them, as the fetched bans may predate
+        them. The stored bans are WATCHed while the diff is computed and
+        written, which is retried if they change. The bans are only fetched
+        once.
+
+        Returns True if any stored ban was changed.
         """
         if not guild.me.guild_permissions.ban_members:
-            return
-
+            return False
+
+        changed = set()
+        self._changed_during_sync[guild.id].append(changed)
+        try:
+            return await self.__sync_bans(guild, changed)
+        finally:
+            syncs = self._changed_during_sync[guild.id]
+            syncs.remove(changed)
+            if len(syncs) <= 0:
+                del self._changed_during_sync[guild.id]
+
+    async def __sync_bans(self, guild, changed):
         bans = await guild.bans()
+        guild_key = self._guild_key_coder.encode(guild.id)
+        fingerprint_key = self._fingerprint_key_coder.encode(guild.id)
+        blocked = await self.is_guild_blocked(guild)
+        ban_protos = {self._id_coder.encode(ban.user.id):
+                      self.__make_ban_proto(guild, ban, blocked=blocked)
+                      for ban in bans}
+        fingerprint = self.__fingerprint(ban_protos)
+        diff = {}
+
+        async def prepare(conn):
+            diff.clear()
+            if len(bans) <= 0 and not await conn.exists(guild_key):
+                return None
+            diff['synced'] = True
+            if await conn.get(fingerprint_key) == fingerprint:
+                return None
+            return await self.__prepare_diff(conn, guild_key, ban_protos,
+                                             fingerprint_key, fingerprint,
+                                             changed, diff)
+
+        results = await redis_watch_transaction(self.redis, (guild_key,),
+                                                prepare)
+        if 'synced' not in diff:
+            return False
+
+        self._pending_expirations[GUILD_BAN_PREFIX].add(guild_key)
+        self._pending_expirations[GUILD_FINGERPRINT_PREFIX].add(
+            fingerprint_key)
+        self._pending_expirations[USER_BAN_PREFIX].update(
+            self._user_key_coder.encode(ban.user.id) for ban in bans)
+
+        if results is None or \
+           (len(diff['removed']) <= 0 and len(diff['updated']) <= 0):
+            return False
+        await self.__add_banned_users(diff['banned'])
+        self.__remove_unbanned_users(diff['removed'], results)
+        log.debug(f'Synced bans for {guild_key}: {len(diff["added"])} added, '
+                  f'{len(diff["removed"])} removed, '
+                  f'{len(diff["updated"]) - len(diff["added"])} updated.')
+        return True
+
+    async def rebuild_filter(self):
+        """|coro| Rebuilds the banned user filter from every user ban key in
+        Redis. Drops users whose bans have since expired from the filter.
+        """
+        previous = self.banned_users
+        capacity = max(MIN_FILTER_CAPACITY,
+                       2 * len(previous) if previous is not None else 0)
+        self._building_filter = bloom.CountingBloomFilter(
+            capacity, FILTER_ERROR_RATE)
+        try:
+            async for key in self.redis.iscan(match=self._user_prefix + b'*'):
+                self._building_filter.add(self._user_key_coder.decode(key))
+            self.banned_users = self._building_filter
+        finally:
+            self._building_filter = None
+        self.filter_counters['rebuilds'] += 1
+
+    def filter_stats(self):
+        """Returns the statistics of the banned user filter, or None if it has
+        not been built yet.
+        """
+        banned_users = self.banned_users
+        if banned_users is None:
+            return None
+        stats = collections.Counter(self.filter_counters)
+        stats['items'] = len(banned_users)
+        stats['capacity'] = banned_users.capacity
+        stats['size_bytes'] = banned_users.size_bytes
+        stats['expected_fp_rate'] = banned_users.false_positive_rate
+        return stats
+
+    def invalidate_local(self, key):
+        """Adds a user banned by another process to the banned user filter.
+        Called by the invalidator.
+        """
+        self.__add_to_filters((self._id_coder.decode(key),))
 
-        if len(bans) <= 0:
+    def flush_local(self):
+        """Drops the banned user filter, as broadcasts of banned users may
+        have been missed. Called by the invalidator. get_user_bans always
+        reads from Redis until the next rebuild_filter.
+        """
+        self.banned_users = None
+
+    def __add_to_filters(self, user_ids):
+        for target in (self.banned_users, self._building_filter):
+            if target is None:
+                continue
+            for user_id in user_ids:
+                target.add(user_id)
+
+    def __ban_users(self, tr, guild_key, user_ids, banned):
+        """Yields the commands that add guild_key to the ban sets of user_ids.
+        Appends (user_id, SADD result, SCARD result) futures to banned, which
+        must be passed to __add_banned_users after the transaction.
+        """
+        for user_id in user_ids:
+            user_key = self._user_key_coder.encode(user_id)
+            added, count = tr.sadd(user_key, guild_key), tr.scard(user_key)
+            banned.append((user_id, added, count))
+            yield added
+            yield count
+            yield tr.expire(user_key, self.timeout)
+
+    async def __add_banned_users(self, banned):
+        """Adds users to the banned user filter that were not banned in any
+        guild before. Users banned in several guilds are only counted once.
+        """
+        user_ids = [user_id for user_id, added, count in banned
+                    if added.result() and count.result() == 1]
+        if len(user_ids) <= 0:
             return
+        self.__add_to_filters(user_ids)
+        if self.invalidator is not None:
+            await self.invalidator.publish(
+                self.NAME, [self._id_coder.encode(user_id)
+                            for user_id in user_ids])
+
+    def __unban_users(self, tr, guild_key, user_ids):
+        """Yields the commands that remove guild_key from the ban sets of
+        user_ids. Must be the last commands in the transaction. The results
+        must be passed to __remove_unbanned_users.
+        """
+        for user_id in user_ids:
+            user_key = self._user_key_coder.encode(user_id)
+            yield tr.srem(user_key, guild_key)
+            yield tr.scard(user_key)
 
-        blocked = self.is_guild_blocked(guild)
-        guild_key = self._guild_key_coder.encode(guild.id)
-        ban_protos = (self.__encode_ban(guild, ban, blocked=blocked)
-                      for ban in bans)
+    def __remove_unbanned_users(self, user_ids, results):
+        """Removes users from the banned user filter that are no longer
+        banned in any guild.
+        """
+        if self.banned_users is None or len(user_ids) <= 0:
+            return
+        results = results[len(results) - 2 * len(user_ids):]
+        for user_id, removed, count in zip(user_ids, results[::2],
+                                           results[1::2]):
+            if removed and count <= 0:
+                self.banned_users.remove(user_id)
+
+    async def flush_expirations(self):
+        """|coro| Refreshes the expiration of every key queued by save_bans,
+        with one command per key prefix.
+        """
+        pending, self._pending_expirations = \
+            self._pending_expirations, collections.defaultdict(set)
+        for keys in pending.values():
+            for chunk in iterable.chunked(keys, MAX_EXPIRE_BATCH_SIZE):
+                await redis_expire_all(self.redis, chunk, self.timeout)
+
+    async def __prepare_diff(self, conn, guild_key, ban_protos,
+                             fingerprint_key, fingerprint, changed, diff):
+        """|coro| Reads the stored bans of a guild and returns the transaction
+        that writes the differences from ban_protos and the new fingerprint.
+        Users in changed are skipped. The differences are stored in diff.
+        """
+        existing = await conn.hgetall(guild_key) or {}
+        removed = [id_enc for id_enc in existing
+                   if id_enc not in ban_protos and id_enc not in changed]
+        added = [id_enc for id_enc in ban_protos
+                 if id_enc not in existing and id_enc not in changed]
+        updated = {
+            id_enc: self._guild_value_coder.encode(ban_proto)
+            for id_enc, ban_proto in ban_protos.items()
+            if id_enc not in changed and (
+                id_enc not in existing or
+                self.__is_stale(existing[id_enc], ban_proto))
+        }
+        # The fingerprint does not match the stored bans if any were skipped.
+        skipped = len(changed) > 0
+        diff.update(added=[self._id_coder.decode(id_enc) for id_enc in added],
+                    removed=[self._id_coder.decode(id_enc)
+                             for id_enc in removed],
+                    updated=updated, banned=[])
 
         def transaction(tr):
-            for chunk in iterable.chunked(ban_protos, MAX_CHUNK_SIZE):
+            if skipped:
+                yield tr.delete(fingerprint_key)
+            else:
+                yield tr.set(fingerprint_key, fingerprint,
+                             expire=self.timeout)
+            for chunk in iterable.chunked(updated.items(), MAX_CHUNK_SIZE):
                 yield tr.hmset_dict(guild_key, dict(chunk))
-            for ban in bans:
-                user_key = self._user_key_coder.encode(ban.user.id)
-                yield tr.sadd(user_key, guild_key)
-                yield tr.expire(user_key, self.timeout)
+            for chunk in iterable.chunked(removed, MAX_CHUNK_SIZE):
+                yield tr.hdel(guild_key, *chunk)
             yield tr.expire(guild_key, self.timeout)
-        await redis_transaction(self.redis, transaction)
+            yield from self.__ban_users(tr, guild_key, diff['added'],
+                                        diff['banned'])
+            yield from self.__unban_users(tr, guild_key, diff['removed'])
+        return transaction
+
+    def __is_stale(self, value_enc, ban_proto):
+        """Checks if a stored ban differs from ban_proto. Guild sizes are only
+        compared by order of magnitude, so ordinary member churn does not
+        rewrite every ban of a guild.
+        """
+        stored = self._guild_value_coder.decode(value_enc)
+        if stored.guild_size.bit_length() != \
+           ban_proto.guild_size.bit_length():
+            return True
+        stored.guild_size = ban_proto.guild_size
+        return stored != ban_proto
+
+    @staticmethod
+    def __fingerprint(ban_protos):
+        digest = hashlib.blake2b(digest_size=16)
+        for id_enc in sorted(ban_protos):
+            ban_proto = ban_protos[id_enc]
+            digest.update(ban_proto.avatar.encode())
+            digest.update(b'\0')
+            digest.update(ban_proto.reason.encode())
+            digest.update(b'\0')
+            digest.update(bytes([ban_proto.guild_blocked,
+                                 ban_proto.guild_size.bit_length()]))
+            digest.update(id_enc)
+        return digest.digest()
+
+    def __mark_changed(self, guild_id, user_id):
+        for changed in self._changed_during_sync.get(guild_id, ()):
+            changed.add(self._id_coder.encode(user_id))
 
     async def save_ban(self, guild, ban):
-        blocked = self.is_guild_blocked(guild)
+        self.__mark_changed(guild.id, ban.user.id)
+        blocked = await self.is_guild_blocked(guild)
         guild_key = self._guild_key_coder.encode(guild.id)
-        user_key = self._user_key_coder.encode(ban.user.id)
-        user_id_enc, guild_value = self.__encode_ban(
-                guild, ban, blocked=blocked)
+        fingerprint_key = self._fingerprint_key_coder.encode(guild.id)
+        user_id_enc = self._id_coder.encode(ban.user.id)
+        guild_value = self._guild_value_coder.encode(
+            self.__make_ban_proto(guild, ban, blocked=blocked))
+
+        banned = []
 
         def transaction(tr):
             yield tr.hset(guild_key, user_id_enc, guild_value)
-            yield tr.sadd(user_key, guild_key)
+            yield tr.delete(fingerprint_key)
             yield tr.expire(guild_key, self.timeout)
-            yield tr.expire(user_key, self.timeout)
+            yield from self.__ban_users(tr, guild_key, (ban.user.id,), banned)
         await redis_transaction(self.redis, transaction)
+        await self.__add_banned_users(banned)
 
     async def get_guild_bans(self, guild_id):
         guild_key = self._guild_key_coder.encode(guild_id)
@@ -100,10 +369,19 @@ class BanStorage:
                 for _, proto_enc in bans_enc.items()]
 
     async def get_user_bans(self, user_id):
+        banned_users = self.banned_users
+        if banned_users is not None:
+            if user_id not in banned_users:
+                self.filter_counters['negatives'] += 1
+                return []
+            self.filter_counters['positives'] += 1
+
         user_key = self._user_key_coder.encode(user_id)
         guild_keys = await self.redis.smembers(user_key)
 
         if guild_keys is None or len(guild_keys) <= 0:
+            if banned_users is not None:
+                self.filter_counters['false_positives'] += 1
             return []
 
         user_id_enc = self._id_coder.encode(user_id)
@@ -111,7 +389,8 @@ class BanStorage:
         def transaction(tr):
             for key in guild_keys:
                 yield tr.hget(key, user_id_enc)
-        results = await redis_transaction(self.redis, transaction)
+        results = await redis_transaction(self.redis, transaction,
+                                          atomic=False)
         return [self._guild_value_coder.decode(proto_enc)
                 for proto_enc in results if proto_enc is not None]
 
@@ -122,25 +401,30 @@ class BanStorage:
         if bans_enc is None:
             return
 
+        fingerprint_key = self._fingerprint_key_coder.encode(guild_id)
+
+        user_ids = [self._id_coder.decode(id_enc) for id_enc in bans_enc]
+
         def transaction(tr):
-            yield tr.delete(guild_key)
-            for id_enc, proto_enc in bans_enc.items():
-                user_id = self._id_coder.decode(id_enc)
-                user_key = self._user_key_coder.encode(user_id)
-                yield tr.srem(user_key, guild_key)
-        await redis_transaction(self.redis, transaction)
+            yield tr.delete(guild_key, fingerprint_key)
+            yield from self.__unban_users(tr, guild_key, user_ids)
+        results = await redis_transaction(self.redis, transaction)
+        self.__remove_unbanned_users(user_ids, results)
 
     async def clear_ban(self, guild, user):
+        self.__mark_changed(guild.id, user.id)
         guild_key = self._guild_key_coder.encode(guild.id)
-        user_key = self._user_key_coder.encode(user.id)
+        fingerprint_key = self._fingerprint_key_coder.encode(guild.id)
         user_id_enc = self._id_coder.encode(user.id)
 
         def transaction(tr):
             yield tr.hdel(guild_key, user_id_enc)
-            yield tr.srem(user_key, guild_key)
-        await redis_transaction(self.redis, transaction)
+            yield tr.delete(fingerprint_key)
+            yield from self.__unban_users(tr, guild_key, (user.id,))
+        results = await redis_transaction(self.redis, transaction)
+        self.__remove_unbanned_users((user.id,), results)
 
-    def __encode_ban(self, guild, ban, blocked=False):
+    def __make_ban_proto(self, guild, ban, blocked=False):
         ban_proto = proto.BanInfo()
         ban_proto.guild_id = guild.id
         ban_proto.guild_size = _get_guild_size(guild)
@@ -150,7 +434,4 @@ class BanStorage:
             ban_proto.avatar = ban.user.avatar
         if ban.reason is not None:
             ban_proto.reason = ban.reason
-
-        id_enc = self._id_coder.encode(ban.user.id)
-        proto_enc = self._guild_value_coder.encode(ban_proto)
-        return (id_enc, proto_enc)
+        return ban_proto
@@ -0,0 +1,110 @@
+import coders
+import time
+from . import bans, compression, storage
+from .redis_utils import redis_transaction
+
+DEFAULT_REDIS_BATCH_SIZES = (1000, 10000, 100000)
+BENCHMARK_KEY = b'hourai:benchmark'
+DEFAULT_SAMPLE_LIMIT = 10000
+
+
+async def benchmark_redis_batches(redis, sizes=DEFAULT_REDIS_BATCH_SIZES,
+                                  repeats=3):
+    """|coro| Compares atomic (MULTI/EXEC) and pipelined batches of HSET and
+    HGET commands against a live Redis instance.
+
+    Returns a list of (operation, batch size, mode, best time in seconds)
+    rows. Uses a scratch hash key, which is deleted afterwards.
+    """
+    results = []
+    try:
+        for size in sizes:
+            fields = [str(i).encode() for i in range(size)]
+            operations = (
+                ('HSET', lambda tr: (tr.hset(BENCHMARK_KEY, field, field)
+                                     for field in fields)),
+                ('HGET', lambda tr: (tr.hget(BENCHMARK_KEY, field)
+                                     for field in fields)),
+            )
+            for name, txn_fn in operations:
+                for atomic in (True, False):
+                    best = None
+                    for _ in range(repeats):
+                        start = time.perf_counter()
+                        await redis_transaction(redis, txn_fn, atomic=atomic)
+                        elapsed = time.perf_counter() - start
+                        best = elapsed if best is None else min(best, elapsed)
+                    mode = 'multi' if atomic else 'pipeline'
+                    results.append((name, size, mode, best))
+            await redis.delete(BENCHMARK_KEY)
+    finally:
+        await redis.delete(BENCHMARK_KEY)
+    return results
+
+
+async def sample_stored_values(redis, limit=DEFAULT_SAMPLE_LIMIT,
+                               decoder=None):
+    """|coro| Reads up to limit stored guild config and ban values of each
+    kind from Redis. decoder must be able to decompress the stored values.
+
+    Returns a dict mapping the kind of value to a list of uncompressed
+    payloads.
+    """
+    decoder = decoder or compression.AdaptiveCompressionCoder()
+    patterns = {
+        'guild_configs': bytes([storage.StoragePrefix.GUILD_CONFIGS.value]),
+        'bans': bytes([storage.StoragePrefix.BANS.value,
+                       bans.GUILD_BAN_PREFIX]),
+    }
+    samples = {}
+    for kind, prefix in patterns.items():
+        values = []
+        async for key in redis.iscan(match=prefix + b'*'):
+            fields = await redis.hgetall(key)
+            fields.pop(storage.GUILD_CONFIG_VERSION_FIELD, None)
+            values.extend(decoder.decode(value) for value in fields.values())
+            if len(values) >= limit:
+                break
+        samples[kind] = values[:limit]
+    return samples
+
+
+def benchmark_compression(samples, zstd_dict=None, repeats=3):
+    """Compares compression coders over lists of uncompressed payloads.
+
+    Returns a list of (kind, coder, count, raw bytes, stored bytes, encode CPU
+    time per value, decode CPU time per value) rows.
+    """
+    candidates = {
+        'zlib': coders.ZlibCoder(),
+        'adaptive': compression.AdaptiveCompressionCoder(),
+    }
+    if zstd_dict is not None:
+        candidates['adaptive+zstd'] = compression.AdaptiveCompressionCoder(
+            zstd_dict=zstd_dict)
+
+    results = []
+    for kind, values in samples.items():
+        if len(values) <= 0:
+            continue
+        raw_size = sum(len(value) for value in values)
+        for name, coder in candidates.items():
+            encode_time = decode_time = None
+            for _ in range(repeats):
+                start = time.process_time()
+                encoded = [coder.encode(value) for value in values]
+                elapsed = time.process_time() - start
+                encode_time = (elapsed if encode_time is None else
+                               min(encode_time, elapsed))
+
+                start = time.process_time()
+                for value in encoded:
+                    coder.decode(value)
+                elapsed = time.process_time() - start
+                decode_time = (elapsed if decode_time is None else
+                               min(decode_time, elapsed))
+            stored_size = sum(len(value) for value in encoded)
+            results.append((kind, name, len(values), raw_size, stored_size,
+                            encode_time / len(values),
+                            decode_time / len(values)))
+    return results
@@ -0,0 +1,70 @@
+import hashlib
+import math
+
+DEFAULT_ERROR_RATE = 0.01
+# Counters saturate at this value and are never decremented afterwards.
+MAX_COUNT = 255
+
+
+class CountingBloomFilter:
+    """A probabilistic set of 64-bit integers. Membership tests never have
+    false negatives, and have false positives at about error_rate while no
+    more than capacity items are in the filter.
+
+    Each slot is a byte counter instead of a single bit, so items can be
+    removed again. Removing an item that was never added is ignored unless it
+    is a false positive, in which case it may cause false negatives.
+    """
+
+    __slots__ = ('counters', 'capacity', 'num_hashes', 'count')
+
+    def __init__(self, capacity, error_rate=DEFAULT_ERROR_RATE):
+        capacity = max(1, capacity)
+        size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.counters = bytearray(size)
+        self.capacity = capacity
+        self.num_hashes = max(1, round(size / capacity * math.log(2)))
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, item):
+        counters = self.counters
+        return all(counters[idx] > 0 for idx in self._indexes(item))
+
+    def add(self, item):
+        counters = self.counters
+        for idx in self._indexes(item):
+            if counters[idx] < MAX_COUNT:
+                counters[idx] += 1
+        self.count += 1
+
+    def remove(self, item):
+        if item not in self:
+            return
+        counters = self.counters
+        for idx in self._indexes(item):
+            if 0 < counters[idx] < MAX_COUNT:
+                counters[idx] -= 1
+        self.count = max(0, self.count - 1)
+
+    @property
+    def size_bytes(self):
+        return len(self.counters)
+
+    @property
+    def false_positive_rate(self):
+        """The expected false positive rate at the current number of items."""
+        size = len(self.counters)
+        return (1 - math.exp(-self.num_hashes * self.count / size)) ** \
+            self.num_hashes
+
+    def _indexes(self, item):
+        # Double hashing: derives every index from two 64-bit hashes.
+        digest = hashlib.blake2b(item.to_bytes(8, 'little'),
+                                 digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        size = len(self.counters)
+        return [(h1 + i * h2) % size for i in range(self.num_hashes)]
@@ -1,6 +1,8 @@
 import asyncio
 import collections
 import functools
+import heapq
+import os
 import time
 import logging
 from abc import abstractmethod, ABC
@@ -8,66 +10,149 @@ from hourai import utils
 from coders import IdentityCoder
 from .redis_utils import redis_transaction
 
+log = logging.getLogger(__name__)
+
+# Local cache TTL used when no invalidation channel is available. Bounds how
+# long a write in another process can go unnoticed.
+DEFAULT_LOCAL_CACHE_TTL = 300
+# Local cache TTL used when writes are broadcast over an invalidation channel.
+# Only acts as a safety net against lost invalidation messages.
+TRACKED_LOCAL_CACHE_TTL = 6 * 60 * 60
+# Entries hit at least REFRESH_AHEAD_HITS times are refreshed in the
+# background once they reach this fraction of the refresh TTL, so hot keys are
+# never served stale.
+REFRESH_AHEAD_RATIO = 0.75
+REFRESH_AHEAD_HITS = 10
+
 
 class LRUCache:
     """A LRU (Least Recently Used) key-value cache with optional TTL for items
     in it. Supports storing any value and hashable key. Not threadsafe.
+
+    Expired items are reaped incrementally from an expiry heap on every write,
+    instead of scanning the whole cache. Hits, misses, expirations and
+    evictions are recorded in counters.
     """
 
-    __slots__ = ("cache", "max_size", "default_ttl")
+    __slots__ = ("cache", "max_size", "default_ttl", "counters", "_expiry",
+                 "_sequence")
     NOT_FOUND = object()
+    # Maximum number of expired items reaped per write.
+    REAP_BATCH_SIZE = 16
 
     class Entry:
-        __slots__ = ("value", "expires")
+        __slots__ = ("value", "expires", "created", "hits", "version")
 
-        def __init__(self, value, ttl):
+        def __init__(self, value, ttl, now, version=None):
             self.value = value
-            logging.debug(f"VALUE: {value} TTL: {ttl}")
-            self.expires = time.time() + ttl if ttl != 0 else None
+            self.created = now
+            self.expires = now + ttl if ttl != 0 else None
+            self.hits = 0
+            self.version = version
 
         @property
         def is_expired(self):
-            return self.expires is not None and time.time() > self.expires
+            return self.expires is not None and time.monotonic() > self.expires
+
+        @property
+        def age(self):
+            return time.monotonic() - self.created
+
+        def touch(self):
+            """Marks the value as freshly validated."""
+            self.created = time.monotonic()
+            self.hits = 0
 
     def __init__(self, max_size=1024, default_ttl=0):
         self.cache = collections.OrderedDict()
         self.max_size = max_size
         self.default_ttl = default_ttl
+        self.counters = collections.Counter()
+        # Min-heap of (expires, sequence, key, entry). May contain entries
+        # that have since been replaced or removed, which are skipped.
+        self._expiry = []
+        self._sequence = 0
+
+    def __len__(self):
+        return len(self.cache)
 
     def get(self, key):
         """Gets the value of a single key in the cache. Move to end of LRU
         queue. Returns LRUCache.NOT_FOUND if no key is there. O(1) time.
         """
+        entry = self.get_entry(key)
+        return LRUCache.NOT_FOUND if entry is None else entry.value
+
+    def get_entry(self, key):
+        """Gets the entry of a single key in the cache and counts a hit on it.
+        Move to end of LRU queue. Returns None if no key is there. O(1) time.
+        """
         entry = self.cache.get(key)
         if entry is None:
-            return LRUCache.NOT_FOUND
+            self.counters['misses'] += 1
+            return None
         if entry.is_expired:
             del self.cache[key]
-            return LRUCache.NOT_FOUND
+            self.counters['expired'] += 1
+            self.counters['misses'] += 1
+            return None
         self.cache.move_to_end(key)
-        return entry.value
+        self.counters['hits'] += 1
+        entry.hits += 1
+        return entry
 
-    def set(self, key, value, ttl: float = 0) -> None:
+    def set(self, key, value, ttl: float = 0, version=None) -> None:
         """Sets the value of a single key in the cache. Added to end of LRU
-        queue. O(1) time.
+        queue. Amortized O(log n) time.
         """
+        now = time.monotonic()
         ttl = ttl or self.default_ttl
-        self.cache[key] = LRUCache.Entry(value, ttl or self.default_ttl)
+        entry = LRUCache.Entry(value, ttl, now, version)
+        self.cache[key] = entry
         self.cache.move_to_end(key)
+        if entry.expires is not None:
+            self._sequence += 1
+            heapq.heappush(self._expiry,
+                           (entry.expires, self._sequence, key, entry))
 
         while len(self.cache) > self.max_size:
             self.cache.popitem(last=False)
+            self.counters['evicted'] += 1
+        self._reap(now, self.REAP_BATCH_SIZE)
 
     def clear(self, key) -> None:
         """Invalidates a single key in the cache."""
-        if key in self.cache:
-            del self.cache[key]
+        self.cache.pop(key, None)
+
+    def clear_all(self) -> None:
+        """Invalidates every key in the cache."""
+        self.cache.clear()
+        self._expiry.clear()
 
-    def flush(self, key) -> None:
+    def flush(self) -> None:
         """Flushes all TTL-expired items from the cache."""
-        pairs = ((key, value) for key, value in self.cache.items()
-                 if not value.is_expired)
-        self.cache = collections.OrderedDict(pairs)
+        self._reap(time.monotonic())
+
+    def _reap(self, now, limit=None):
+        expiry = self._expiry
+        while expiry and (limit is None or limit > 0):
+            expires, _, key, entry = expiry[0]
+            if self.cache.get(key) is not entry:
+                # Replaced, removed or evicted since being scheduled.
+                heapq.heappop(expiry)
+                continue
+            if expires > now:
+                break
+            heapq.heappop(expiry)
+            del self.cache[key]
+            self.counters['expired'] += 1
+            if limit is not None:
+                limit -= 1
+        # Drop references to replaced entries if they accumulate.
+        if len(expiry) > 2 * len(self.cache) + self.REAP_BATCH_SIZE:
+            self._expiry = [item for item in expiry
+                            if self.cache.get(item[2]) is item[3]]
+            heapq.heapify(self._expiry)
 
 
 class KeyValueStore(ABC):
@@ -94,13 +179,28 @@ class KeyValueStore(ABC):
         """
         raise NotImplementedError
 
+    async def get_versioned(self, key):
+        """|coro| Gets the value for a key along with the current version of
+        it. Returns a (value, version) tuple. The version is None if the store
+        does not track versions.
+        """
+        return await self.get(key), None
+
+    async def get_version(self, key):
+        """|coro| Gets the current version of a key. Returns None if the store
+        does not track versions.
+        """
+        return None
+
     async def get_all(self, keys):
         """|coro| Gets the values for multiple keys. Generally should be an
         atomic operation, but may not be depending on implementation.
+
+        Returns a dict mapping each key to its value.
         """
-        tasks = [(key, self.get(key)) for key in keys]
-        await asyncio.gather(*[task for key, task in tasks])
-        return {key: task.result() for key, task in tasks}
+        keys = list(keys)
+        results = await asyncio.gather(*[self.get(key) for key in keys])
+        return dict(zip(keys, results))
 
     async def set_all(self, mapping):
         """|coro| Sets the values for multiple keys. Generally should be an
@@ -117,14 +217,89 @@ class KeyValueStore(ABC):
         await asyncio.gather(*[self.clear(key) for key in keys])
 
 
+class BatchLoader:
+    """Merges individual loads issued close together into a single batched
+    load, in the style of DataLoader.
+
+    Loads issued within `window` seconds of the first pending load, or within
+    the same event loop iteration if window is 0, are resolved by one call to
+    batch_fn. batch_fn is a coroutine function that takes a list of keys and
+    returns a list of their values in the same order. Duplicate keys in a batch
+    are only loaded once.
+    """
+
+    def __init__(self, batch_fn, *, window=0, max_batch_size=1024):
+        self.batch_fn = batch_fn
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.counters = collections.Counter()
+        self._pending = {}
+        self._handle = None
+
+    async def load(self, key):
+        """|coro| Loads the value for a single key as a part of a batch."""
+        future = self._pending.get(key)
+        if future is None:
+            future = self._schedule(key)
+        else:
+            self.counters['deduplicated'] += 1
+        return await asyncio.shield(future)
+
+    def _schedule(self, key):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._pending[key] = future
+        if len(self._pending) >= self.max_batch_size:
+            self._dispatch()
+        elif self._handle is None:
+            if self.window <= 0:
+                self._handle = loop.call_soon(self._dispatch)
+            else:
+                self._handle = loop.call_later(self.window, self._dispatch)
+        return future
+
+    def _dispatch(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        batch, self._pending = self._pending, {}
+        if len(batch) <= 0:
+            return
+        self.counters['batches'] += 1
+        self.counters['keys'] += len(batch)
+        asyncio.ensure_future(self._run_batch(batch))
+
+    async def _run_batch(self, batch):
+        try:
+            results = await self.batch_fn(list(batch.keys()))
+        except Exception as error:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(error)
+            return
+        for future, result in zip(batch.values(), results):
+            if not future.done():
+                future.set_result(result)
+
+
 class RedisStore(KeyValueStore):
+    """Stores values in top level Redis keys.
+
+    If batch_window is not None, concurrent gets are merged into batched
+    reads. See BatchLoader for details.
+    """
 
-    def __init__(self, redis, timeout=0):
+    def __init__(self, redis, timeout=0, batch_window=None):
         self.redis = redis
         self.timeout = timeout
+        self.loader = None
+        if batch_window is not None:
+            self.loader = BatchLoader(self._load_batch, window=batch_window)
 
     async def get(self, key):
         """|coro| Gets the value for a key. Is an atomic operation."""
+        if self.loader is not None:
+            return await self.loader.load(key)
         return await self.redis.get(key)
 
     async def set(self, key, value):
@@ -137,7 +312,10 @@ class RedisStore(KeyValueStore):
 
     async def get_all(self, keys):
         """|coro| Gets the values for multiple keys. Is an atomic operation."""
-        return await self._batch_do(keys, lambda tr, key: tr.get(key))
+        keys = list(keys)
+        if len(keys) <= 0:
+            return {}
+        return dict(zip(keys, await self._load_batch(keys)))
 
     async def set_all(self, mapping):
         """|coro| Sets the values for multiple keys. Is an atomic operation."""
@@ -148,54 +326,113 @@ class RedisStore(KeyValueStore):
         """|coro| Deletes the value for a key. Is an atomic operation."""
         await self._batch_do(keys, lambda tr, key: tr.delete(key))
 
+    async def _load_batch(self, keys):
+        """|coro| Gets the values for a non-empty list of keys in one round
+        trip. Returns a list of values in the same order.
+        """
+        return await self.redis.mget(*keys)
+
     async def _batch_do(self, iterable, func):
         """|coro| Runs identical operations over every item in an iterable as an
         atomic transaction. func is a function that takes (transaction, value)
         as an input."""
-        await self._transaction(
+        return await self._transaction(
                 lambda tr: (func(tr, value) for value in iterable))
 
-    async def _transaction(self, txn_fn):
+    async def _transaction(self, txn_fn, atomic=True):
         """|coro| Runs arbitrary operations as an atomic Redis transaction.
         txn_fn is a finite generator function that takes a transaction as an
-        argument and yields awaitable transaction operations."""
-        return await redis_transaction(self.redis, txn_fn)
+        argument and yields awaitable transaction operations. If atomic is
+        False, the operations are pipelined without MULTI/EXEC."""
+        return await redis_transaction(self.redis, txn_fn, atomic=atomic)
+
+
+def _decode_version(version):
+    return 0 if version is None else int(version)
 
 
 class RedisHashStore(RedisStore):
     """ Stores values in Redis hash fields. Key value is a 2-Tuple of
     (key, field).
+
+    If version_field is not None, every write to a hash atomically increments
+    the integer stored in that field of the hash, which allows readers to
+    cheaply check whether any field has changed. Versions only increase as
+    long as the hash is never deleted or expired as a whole.
     """
 
+    def __init__(self, redis, timeout=0, batch_window=None,
+                 version_field=None):
+        super().__init__(redis, timeout=timeout, batch_window=batch_window)
+        self.version_field = version_field
+
+    async def get_versioned(self, key):
+        """|coro| Gets the value for a key and field along with the version of
+        the hash. Is an atomic operation.
+        """
+        if self.version_field is None:
+            return await self.get(key), None
+        if self.loader is not None:
+            value, version = await asyncio.gather(
+                self.loader.load(key),
+                self.loader.load((key[0], self.version_field)))
+        else:
+            value, version = await self.redis.hmget(key[0], key[1],
+                                                    self.version_field)
+        return value, _decode_version(version)
+
+    async def get_version(self, key):
+        """|coro| Gets the version of the hash containing a key and field."""
+        if self.version_field is None:
+            return None
+        if self.loader is not None:
+            version = await self.loader.load((key[0], self.version_field))
+        else:
+            version = await self.redis.hget(key[0], self.version_field)
+        return _decode_version(version)
+
     async def get(self, key):
         """|coro| Gets the value for a key and field. Is an atomic operation.
         """
+        if self.loader is not None:
+            return await self.loader.load(key)
         return await self.redis.hget(*key)
 
     async def set(self, key, value):
         """|coro| Sets the value for a key and field. Is an atomic operation.
         """
-        if self.timeout <= 0:
+        if self.timeout <= 0 and self.version_field is None:
             await self.redis.hset(key[0], key[1], value)
             return
 
         def txn_fn(tr):
             yield tr.hset(key[0], key[1], value)
-            yield tr.expire(key[0], self.timeout)
+            yield from self._bump_version(tr, key[0])
+            if self.timeout > 0:
+                yield tr.expire(key[0], self.timeout)
         await self._transaction(txn_fn)
 
     async def clear(self, key):
         """|coro| Deletes the value for a key and field. Is an atomic
         operation.
         """
-        await self.redis.hdel(key[0], key[1])
+        if self.version_field is None:
+            await self.redis.hdel(key[0], key[1])
+            return
+
+        def txn_fn(tr):
+            yield tr.hdel(key[0], key[1])
+            yield from self._bump_version(tr, key[0])
+        await self._transaction(txn_fn)
 
     async def get_all(self, keys):
         """|coro| Get the values for a set of keys and fields. Is an atomic
         operation.
         """
-        results = await self._batch_do(keys, lambda tr, key: tr.hget(*key))
-        return dict(zip(keys, results))
+        keys = list(keys)
+        if len(keys) <= 0:
+            return {}
+        return dict(zip(keys, await self._load_batch(keys)))
 
     async def set_all(self, mapping):
         """|coro| Set the values for a set of keys and fields. Is an atomic
@@ -204,6 +441,7 @@ class RedisHashStore(RedisStore):
         def txn_fn(tr):
             for key, group in self._group_by_key(mapping):
                 yield tr.hmset_dict(key, group)
+                yield from self._bump_version(tr, key)
                 if self.timeout > 0:
                     yield tr.expire(key, self.timeout)
         await self._transaction(txn_fn)
@@ -212,7 +450,36 @@ class RedisHashStore(RedisStore):
         """|coro| Delete the values for set of keys and fields. Is an atomic
         operation.
         """
-        await self._batch_do(keys, lambda tr, key: tr.hdel(*key))
+        keys = list(keys)
+
+        def txn_fn(tr):
+            for key in keys:
+                yield tr.hdel(*key)
+            for key in set(key for key, _ in keys):
+                yield from self._bump_version(tr, key)
+        await self._transaction(txn_fn)
+
+    def _bump_version(self, tr, key):
+        if self.version_field is not None:
+            yield tr.hincrby(key, self.version_field)
+
+    async def _load_batch(self, keys):
+        """|coro| Gets the values for a non-empty list of (key, field) pairs
+        with one HMGET per key in a single round trip. Returns a list of
+        values in the same order.
+        """
+        groups = {}
+        for key, field in keys:
+            groups.setdefault(key, []).append(field)
+        results = await self._transaction(
+            lambda tr: (tr.hmget(key, *fields)
+                        for key, fields in groups.items()),
+            atomic=False)
+        values = {}
+        for (key, fields), result in zip(groups.items(), results):
+            values.update(((key, field), value)
+                          for field, value in zip(fields, result))
+        return [values[key] for key in keys]
 
     def _group_by_key(self, mapping):
         groups = {}
@@ -224,34 +491,228 @@ class RedisHashStore(RedisStore):
         return ((key, dict(group)) for key, group in groups.items())
 
 
+class CacheInvalidator:
+    """Propagates local cache invalidations between processes over a Redis
+    pub/sub channel.
+
+    Caches register under a unique name. Whenever a registered cache writes to
+    or clears a key, the invalidator publishes the cache's name and the key on
+    the channel, and every other subscribed process evicts the matching entry
+    from its local cache. If the subscription is lost, every registered local
+    cache is flushed as invalidations may have been missed.
+    """
+
+    DEFAULT_CHANNEL = b'hourai:cache:invalidate'
+    ORIGIN_SIZE = 8
+
+    def __init__(self, redis, *, channel=DEFAULT_CHANNEL, retry_delay=1.0):
+        self.redis = redis
+        self.channel = channel
+        self.retry_delay = retry_delay
+        self.origin = os.urandom(self.ORIGIN_SIZE)
+        self._caches = {}
+        self._task = None
+
+    def register(self, name, cache):
+        """Registers a cache to receive invalidations under a given name."""
+        name = name.encode()
+        assert 0 < len(name) <= 255
+        assert name not in self._caches, f'Cache "{name}" already registered.'
+        self._caches[name] = cache
+
+    def start(self):
+        """Starts listening for invalidations from other processes."""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._listen())
+
+    async def close(self):
+        """|coro| Stops listening for invalidations from other processes."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def publish(self, name, keys):
+        """|coro| Broadcasts the invalidation of encoded local keys in a named
+        cache to all other processes.
+        """
+        name = name.encode()
+        prefix = self.origin + bytes([len(name)]) + name
+        await asyncio.gather(*[self.redis.publish(self.channel, prefix + key)
+                               for key in keys])
+
+    def flush_all(self):
+        """Drops every entry in all registered local caches."""
+        for cache in self._caches.values():
+            cache.flush_local()
+
+    async def _listen(self):
+        while True:
+            try:
+                channel, = await self.redis.subscribe(self.channel)
+                # Anything written before subscribing may have been missed.
+                self.flush_all()
+                while await channel.wait_message():
+                    self._handle_message(await channel.get())
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('Error in cache invalidation listener:')
+            self.flush_all()
+            await asyncio.sleep(self.retry_delay)
+
+    def _handle_message(self, msg):
+        origin, msg = msg[:self.ORIGIN_SIZE], msg[self.ORIGIN_SIZE:]
+        if origin == self.origin or len(msg) <= 0:
+            return
+        name_end = msg[0] + 1
+        cache = self._caches.get(msg[1:name_end])
+        if cache is not None:
+            cache.invalidate_local(msg[name_end:])
+
+
 class Cache(KeyValueStore):
-    """A wrapper around a backing store for caching data."""
+    """A wrapper around a backing store for caching data.
+
+    If an invalidator is provided, writes made through this cache are
+    broadcast to the same cache in other processes, which allows local entries
+    to live much longer. invalidation_key_coder must be able to losslessly
+    encode and decode the keys used with this cache, and defaults to key_coder.
+
+    If refresh_ttl is set, local entries older than it are still returned
+    immediately, but are refreshed from the backing store in the background
+    (stale-while-revalidate). Frequently hit entries are refreshed shortly
+    before reaching it. Entries are only dropped once local_cache_ttl passes.
+    """
 
     def __init__(self, store, *,
                  key_coder=IdentityCoder(),
                  value_coder=IdentityCoder(),
                  local_cache_size=2048,
+                 local_cache_ttl=None,
+                 name=None,
+                 invalidator=None,
+                 invalidation_key_coder=None,
+                 refresh_ttl=0,
+                 refresh_ahead_hits=REFRESH_AHEAD_HITS,
                  timeout=None):
         self.store = store
         self.key_coder = key_coder
         self.value_coder = value_coder
-
-        # FIXME: This will not work when we need to scale to multiple
-        # processes/machines. Implement proper server-assisted client-side
-        # caching.
+        self.name = name
+        self.invalidator = invalidator
+        self.invalidation_key_coder = invalidation_key_coder or key_coder
+        self.refresh_ttl = refresh_ttl
+        self.refresh_ahead_hits = refresh_ahead_hits
+
+        if local_cache_ttl is None:
+            local_cache_ttl = (DEFAULT_LOCAL_CACHE_TTL if invalidator is None
+                               else TRACKED_LOCAL_CACHE_TTL)
         self.local_cache = LRUCache(max_size=local_cache_size,
-                                    default_ttl=300)
+                                    default_ttl=local_cache_ttl)
+        # Incremented on every local invalidation. Used to avoid caching
+        # values fetched before a concurrent invalidation.
+        self._generation = 0
+        # In-flight lookups, keyed by unencoded key. Concurrent misses on the
+        # same key await the same future instead of each hitting the store.
+        self._pending_gets = {}
+        self._pending_loads = {}
+        self.counters = collections.Counter()
+
+        if invalidator is not None:
+            assert name is not None, 'Invalidated caches must be named.'
+            invalidator.register(name, self)
 
     async def get(self, key):
         """|coro| Get the value for a key and field. Atomicity depends on
         underlying store.
         """
-        cached = self.local_cache.get(key)
+        cached = self.get_local(key)
         if cached != LRUCache.NOT_FOUND:
             return cached
-        value = await self.store.get(self.key_coder.encode(key))
+        return await self._coalesce(self._pending_gets, key, 'get_coalesced',
+                                    self._fetch, key)
+
+    def get_local(self, key):
+        """Gets the value for a key from the local cache. Returns
+        LRUCache.NOT_FOUND if it is not cached. Schedules a background refresh
+        if the cached value is stale or about to become stale.
+        """
+        entry = self.local_cache.get_entry(key)
+        if entry is None:
+            return LRUCache.NOT_FOUND
+        if self.refresh_ttl > 0 and key not in self._pending_gets:
+            age = entry.age
+            if age >= self.refresh_ttl:
+                self._refresh(key, entry, 'refreshed_stale')
+            elif (entry.hits >= self.refresh_ahead_hits and
+                  age >= self.refresh_ttl * REFRESH_AHEAD_RATIO):
+                self._refresh(key, entry, 'refreshed_ahead')
+        return entry.value
+
+    def _refresh(self, key, entry, counter):
+        """Refreshes a local entry in the background. If the entry is
+        versioned, only its version is read unless it has changed.
+        """
+        self.counters[counter] += 1
+        if entry.version is None:
+            args = (self._fetch, key)
+        else:
+            args = (self._revalidate, key, entry)
+        future = self._start_pending(self._pending_gets, key, 'get_coalesced',
+                                     *args)
+        future.add_done_callback(self._log_refresh_error)
+
+    def _log_refresh_error(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            log.error(f'Failed to refresh cache "{self.name}":',
+                      exc_info=future.exception())
+
+    async def _fetch(self, key):
+        generation = self._generation
+        value, version = await self.store.get_versioned(
+            self.key_coder.encode(key))
+        return self.populate_local(key, value, generation, version)
+
+    async def _revalidate(self, key, entry):
+        generation = self._generation
+        version = await self.store.get_version(self.key_coder.encode(key))
+        if version != entry.version:
+            return await self._fetch(key)
+        if generation == self._generation:
+            entry.touch()
+        self.counters['revalidated'] += 1
+        return entry.value
+
+    def stats(self):
+        """Returns a Counter of the local cache's hits, misses, expirations,
+        evictions and current size, along with this cache's own counters.
+        """
+        stats = self.local_cache.counters + self.counters
+        stats['size'] = len(self.local_cache)
+        stats['max_size'] = self.local_cache.max_size
+        return stats
+
+    @property
+    def generation(self):
+        """A counter that is incremented on every local invalidation."""
+        return self._generation
+
+    def populate_local(self, key, value, generation, version=None):
+        """Decodes a value read from the backing store and caches it locally,
+        along with its version, if any.
+
+        The value is not cached if the key may have been invalidated since
+        generation was read, as it may be stale. Returns the decoded value.
+        """
         ret_val = None if value is None else self.value_coder.decode(value)
-        self.local_cache.set(key, ret_val, ttl=self.store.timeout)
+        if generation == self._generation:
+            self.local_cache.set(key, ret_val, ttl=self.store.timeout,
+                                 version=version)
         return ret_val
 
     async def set(self, key, message):
@@ -260,117 +721,234 @@ class Cache(KeyValueStore):
         """
         await self.store.set(self.key_coder.encode(key),
                              self.value_coder.encode(message))
-        self.local_cache.clear(key)
+        await self.invalidate(key)
 
     async def clear(self, key):
         """|coro| Deletes the value for a key and field. Atomicity depends on
         underlying store.
         """
         await self.store.clear(self.key_coder.encode(key))
+        await self.invalidate(key)
+
+    def invalidate_local(self, key_enc):
+        """Evicts a key, encoded with invalidation_key_coder, from the local
+        cache.
+        """
+        self._clear_local(self.invalidation_key_coder.decode(key_enc))
+
+    def flush_local(self):
+        """Evicts every key from the local cache."""
+        self._generation += 1
+        self._pending_gets.clear()
+        self.local_cache.clear_all()
+
+    def _clear_local(self, key):
+        self._generation += 1
+        # Lookups started before the invalidation may return stale values.
+        # Later callers must not join them.
+        self._pending_gets.pop(key, None)
         self.local_cache.clear(key)
 
+    async def _coalesce(self, pending, key, counter, func, *args):
+        """|coro| Runs func(*args) unless a call for the same key is already in
+        flight, in which case the result of that call is awaited instead.
+        """
+        return await asyncio.shield(
+            self._start_pending(pending, key, counter, func, *args))
+
+    def _start_pending(self, pending, key, counter, func, *args):
+        future = pending.get(key)
+        if future is not None:
+            self.counters[counter] += 1
+            return future
+
+        future = asyncio.ensure_future(func(*args))
+        pending[key] = future
+
+        def _remove_pending(fut):
+            if pending.get(key) is fut:
+                del pending[key]
+        future.add_done_callback(_remove_pending)
+        return future
+
+    async def invalidate(self, *keys):
+        """|coro| Evicts keys from the local cache of this cache in this and,
+        if an invalidator was provided, every other process.
+        """
+        for key in keys:
+            self._clear_local(key)
+        if self.invalidator is not None:
+            await self.invalidator.publish(
+                self.name, [self.invalidation_key_coder.encode(key)
+                            for key in keys])
+
     async def get_all(self, keys):
-        """|coro| Deletes the value for a key and field. Atomicity depends on
+        """|coro| Gets the values for multiple keys. Atomicity depends on
         underlying store.
         """
         # Check local cache for present keys
-        local_cache = [self.local_cache.get(key) for key in keys]
-        key_count = len(local_cache)
+        keys = list(keys)
+        local_cache = [self.get_local(key) for key in keys]
         local_cache = {key: value for key, value in zip(keys, local_cache)
                        if value != LRUCache.NOT_FOUND}
-        if len(local_cache) == key_count:
+        missing = [key for key in keys if key not in local_cache]
+        if len(missing) <= 0:
             # Everything in cache
             return local_cache
 
         # Fetch missing in remote
-        encoded_keys = [self.key_coder.encode(key) for key in keys
-                        if key not in local_cache]
+        generation = self._generation
+        encoded_keys = [self.key_coder.encode(key) for key in missing]
         results = await self.store.get_all(encoded_keys)
-        ret_val = {
-            self.key_coder.decode(key):
-            self.value_coder.decode(value) if value is not None else None
-            for key, value in results.items()
-        }
-        for key, value in ret_val.items():
-            self.local_cache.set(key, value, ttl=self.store.timeout)
+        ret_val = {key: self.populate_local(key, results[key_enc], generation)
+                   for key, key_enc in zip(missing, encoded_keys)}
         return {**local_cache, **ret_val}
 
     async def set_all(self, mapping):
-        """|coro| Deletes the value for a key and field. Atomicity depends on
+        """|coro| Sets the values for multiple keys. Atomicity depends on
         underlying store.
         """
-        mapping = {self.key_coder.encode(key): self.value_coder.encode(value)
+        encoded = {self.key_coder.encode(key): self.value_coder.encode(value)
                    for key, value in mapping.items()}
-        await self.store.set_all(mapping)
-        for key in mapping.keys():
-            self.local_cache.clear(key)
+        await self.store.set_all(encoded)
+        await self.invalidate(*mapping.keys())
 
     def getter(self, func, key_func):
         """Decorator function that caches a getter function for a Protobuffer.
 
         The wrapped function must always return the message type or None if not
-        found
+        found.
+
+        Concurrent calls for the same key share a single invocation of the
+        wrapped function.
         """
-        @functools.wraps(func)
-        async def get_message(self, *args, **kwargs):
-            key = key_func(*args, **kwargs)
-            cached_message = await self.get(key)
+        cache = self
+
+        async def load_message(key, *args, **kwargs):
+            cached_message = await cache.get(key)
             if cached_message is not None:
                 return cached_message
             value = await utils.maybe_coroutine(func, *args, **kwargs)
             if value is not None:
-                await self.set(key, value)
+                await cache.set(key, value)
             return value
+
+        @functools.wraps(func)
+        async def get_message(self, *args, **kwargs):
+            key = key_func(*args, **kwargs)
+            return await cache._coalesce(
+                cache._pending_loads, key, 'getter_coalesced',
+                functools.partial(load_message, key, self, *args, **kwargs))
         return get_message
 
     def setter(self, func, key_func):
         """Decorator funtion that properly clears a cache value when changing
         the value of it in a setter function.
         """
+        cache = self
+
         @functools.wraps(func)
         async def clear_message(self, *args, **kwargs):
             key = key_func(*args, **kwargs)
-            await self.clear(key)
-            await utils.maybe_coroutine(func, *args, **kwargs)
+            await cache.clear(key)
+            await utils.maybe_coroutine(func, self, *args, **kwargs)
         return clear_message
 
 
 class AggregateProtoHashCache(RedisStore):
-    """A KeyValueStore that stores protocol buffers in Redis hashes."""
+    """A KeyValueStore that stores protocol buffers in Redis hashes.
 
-    class Entry(collections.namedtuple('_Entry',
-                                       'field field_name value_coder')):
+    Each submessage is stored in its own hash field. Decoded submessages are
+    cached locally by a per-field Cache reading from the same hash field, so
+    invalidations are tracked per field. Reading a full message costs at most
+    one HMGET for the fields missing from the local caches.
+
+    version_field should match the version_field of the per-field caches'
+    stores. See RedisHashStore.
+    """
+
+    class Entry(collections.namedtuple('_Entry', 'field field_name cache')):
         pass
 
-    def __init__(self, redis, msg_type, *, value_coders,
-                 timeout=0, key_coder=IdentityCoder()):
-        super().__init__(redis, timeout=timeout)
+    def __init__(self, redis, msg_type, *, entries, timeout=0,
+                 key_coder=IdentityCoder(), batch_window=None,
+                 version_field=None):
+        super().__init__(redis, timeout=timeout, batch_window=batch_window)
+        self.version_field = version_field
         self.msg_type = msg_type
         self.key_coder = key_coder
-        self.value_coders = value_coders
-        self._fields = [entry.field for entry in value_coders]
+        self.entries = entries
         self._validate_config()
 
     def _validate_config(self):
         proto_val = self.msg_type
-        for entry in self.value_coders:
+        for entry in self.entries:
             assert hasattr(proto_val, entry.field_name), \
                 f"{self.msg_type} does not have attribute {entry.field_name}"
 
     async def get(self, key):
-        """|coro| Gets the value for a key. Is atomic."""
-        key_enc = self.key_coder.encode(key)
+        """|coro| Gets the value for a key. Is atomic if no field is locally
+        cached.
+        """
         proto_val = self.msg_type()
-
-        results = await self.redis.hmget(key_enc, *self._fields)
-        for entry, result_enc in zip(self.value_coders, results):
-            if result_enc is None:
-                continue
-            result = entry.value_coder.decode(result_enc)
-            getattr(proto_val, entry.field_name).CopyFrom(result)
-
+        missing = self._get_local(key, proto_val)
+        if len(missing) <= 0:
+            return proto_val
+
+        request = self._create_request(key, missing)
+        if self.loader is not None:
+            results = await self.loader.load(request)
+        else:
+            results = await self.redis.hmget(request[0], *request[1])
+        self._populate_local(key, missing, results, proto_val)
         return proto_val
 
+    async def prefetch(self, keys):
+        """|coro| Loads the values for multiple keys into the local caches in a
+        single pipelined round trip. Keys that are fully cached locally are
+        skipped. Returns the number of keys loaded.
+        """
+        missing = {}
+        for key in keys:
+            key_missing = self._get_local(key, None)
+            if len(key_missing) > 0:
+                missing[key] = key_missing
+        if len(missing) <= 0:
+            return 0
+
+        results = await self._load_batch(
+            [self._create_request(key, key_missing)
+             for key, key_missing in missing.items()])
+        for (key, key_missing), result in zip(missing.items(), results):
+            self._populate_local(key, key_missing, result, None)
+        return len(missing)
+
+    def _get_local(self, key, proto_val):
+        missing = []
+        for entry in self.entries:
+            cached = entry.cache.get_local(key)
+            if cached == LRUCache.NOT_FOUND:
+                missing.append((entry, entry.cache.generation))
+            elif cached is not None and proto_val is not None:
+                getattr(proto_val, entry.field_name).CopyFrom(cached)
+        return missing
+
+    def _create_request(self, key, missing):
+        fields = tuple(entry.field for entry, _ in missing)
+        if self.version_field is not None:
+            fields += (self.version_field,)
+        return self.key_coder.encode(key), fields
+
+    def _populate_local(self, key, missing, results, proto_val):
+        version = None
+        if self.version_field is not None:
+            version = _decode_version(results[-1])
+        for (entry, generation), result_enc in zip(missing, results):
+            result = entry.cache.populate_local(key, result_enc, generation,
+                                                version)
+            if result is not None and proto_val is not None:
+                getattr(proto_val, entry.field_name).CopyFrom(result)
+
     async def set(self, key, value):
         """|coro| Sets the value for a key and field. Is atomic."""
         assert isinstance(value, self.msg_type)
@@ -378,9 +956,9 @@ class AggregateProtoHashCache(RedisStore):
         key_enc = self.key_coder.encode(key)
         fields = {}
         missing_fields = []
-        for entry in self.value_coders:
+        for entry in self.entries:
             if value.HasField(entry.field_name):
-                fields[entry.field] = entry.value_coder.encode(
+                fields[entry.field] = entry.cache.value_coder.encode(
                         getattr(value, entry.field_name))
             else:
                 missing_fields.append(entry.field)
@@ -390,13 +968,38 @@ class AggregateProtoHashCache(RedisStore):
                 yield tr.hmset_dict(key_enc, fields)
             if len(missing_fields) > 0:
                 yield tr.hdel(key_enc, *missing_fields)
+            if self.version_field is not None:
+                yield tr.hincrby(key_enc, self.version_field)
             if self.timeout > 0:
                 yield tr.expire(key_enc, self.timeout)
         await self._transaction(txn_fn)
+        await self._invalidate_fields(key)
 
     async def clear(self, key):
         """|coro| Deletes the value for a key and field. Is atomic."""
-        await self.redis.delete(self.key_coder.encode(key))
+        key_enc = self.key_coder.encode(key)
+        if self.version_field is None:
+            await self.redis.delete(key_enc)
+        else:
+            # Keep the version field so that versions never go backwards.
+            def txn_fn(tr):
+                yield tr.hdel(key_enc, *(entry.field
+                                         for entry in self.entries))
+                yield tr.hincrby(key_enc, self.version_field)
+            await self._transaction(txn_fn)
+        await self._invalidate_fields(key)
+
+    async def _load_batch(self, keys):
+        """|coro| Runs HMGETs for a list of (key, fields) pairs in a single
+        round trip.
+        """
+        return await self._transaction(
+            lambda tr: (tr.hmget(key, *fields) for key, fields in keys),
+            atomic=False)
+
+    async def _invalidate_fields(self, key):
+        await asyncio.gather(*[entry.cache.invalidate(key)
+                               for entry in self.entries])
 
 
 class AggregateProtoCache:
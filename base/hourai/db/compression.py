@@ -0,0 +1,87 @@
+import coders
+import logging
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+log = logging.getLogger(__name__)
+
+# Payloads smaller than this, in bytes, are stored uncompressed. Compressing
+# them costs CPU and rarely saves any space.
+DEFAULT_MIN_SIZE = 128
+DEFAULT_ZSTD_LEVEL = 3
+
+
+class AdaptiveCompressionCoder(coders.Coder):
+    """A Coder that compresses bytes-like objects only when it is worthwhile.
+
+    Like coders.ZlibCoder, a header byte is prepended to specify how the
+    message is stored, and the message is stored uncompressed if compressing
+    does not make it smaller. The header values of coders.ZlibCoder are
+    preserved, so any value written by it can be decoded by this Coder.
+
+    If a zstd dictionary is provided, it is used instead of zlib. The same
+    dictionary must be provided to decode those values. Requires the
+    zstandard package.
+    """
+
+    UNCOMPRESSED = coders.ZlibCoder.UNCOMPRESSED
+    ZLIB = coders.ZlibCoder.COMPRESSED
+    ZSTD_DICT = 2
+
+    def __init__(self, *, min_size=DEFAULT_MIN_SIZE, level=-1,
+                 zstd_dict=None, zstd_level=DEFAULT_ZSTD_LEVEL):
+        self.min_size = min_size
+        self.level = level
+        self._compressor = None
+        self._decompressor = None
+        if zstd_dict is not None:
+            if zstandard is None:
+                raise RuntimeError('zstandard must be installed to use a '
+                                   'compression dictionary.')
+            zstd_dict = zstandard.ZstdCompressionDict(zstd_dict)
+            self._compressor = zstandard.ZstdCompressor(
+                level=zstd_level, dict_data=zstd_dict,
+                write_content_size=True, write_dict_id=False)
+            self._decompressor = zstandard.ZstdDecompressor(
+                dict_data=zstd_dict)
+
+    def encode(self, msg):
+        if len(msg) < self.min_size:
+            return bytes([self.UNCOMPRESSED]) + msg
+        if self._compressor is not None:
+            header = self.ZSTD_DICT
+            compressed = self._compressor.compress(msg)
+        else:
+            header = self.ZLIB
+            compressed = zlib.compress(msg, level=self.level)
+        if len(msg) <= len(compressed):
+            return bytes([self.UNCOMPRESSED]) + msg
+        return bytes([header]) + compressed
+
+    def decode(self, buf):
+        assert len(buf) > 0
+        header = buf[0]
+        if header == self.UNCOMPRESSED:
+            return buf[1:]
+        if header == self.ZLIB:
+            return zlib.decompress(buf[1:])
+        if header == self.ZSTD_DICT:
+            if self._decompressor is None:
+                raise ValueError('Value was compressed with a zstd '
+                                 'dictionary, but none was provided.')
+            return self._decompressor.decompress(buf[1:])
+        raise ValueError(f'Unknown compression header: {header}')
+
+
+def train_zstd_dictionary(samples, size=16 * 1024):
+    """Trains a zstd dictionary of up to size bytes on a list of uncompressed
+    sample payloads. Returns the raw dictionary bytes.
+    """
+    if zstandard is None:
+        raise RuntimeError('zstandard must be installed to train a '
+                           'compression dictionary.')
+    return zstandard.train_dictionary(size, list(samples)).as_bytes()
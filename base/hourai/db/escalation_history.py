@@ -2,6 +2,8 @@ import collections
 from . import models
 from datetime import datetime, timedelta
 from hourai.db import proto
+from sqlalchemy import func
+from sqlalchemy.dialects import postgresql
 
 
 EscalationResult = collections.namedtuple(
@@ -31,14 +33,21 @@ class UserEscalationHistory:
         self.guild = guild
         self.guild_proxy = bot.get_guild_proxy(guild)
 
-        self.entries = list(self.__query_history())
+        self._entries = None
+        self._level = None
+
+    @property
+    def entries(self):
+        """The user's full escalation history, oldest first. Only loaded
+        when first accessed.
+        """
+        if self._entries is None:
+            self._entries = list(self.__query_history())
+        return self._entries
 
     @property
     def current_level(self):
-        level = -1
-        for entry in self.entries:
-            level = max(-1, level + entry.level_delta)
-        return level
+        return self.__get_level().level
 
     def escalate(self, authorizer, reason):
         """|coro|
@@ -71,7 +80,7 @@ class UserEscalationHistory:
             raise EscalationException(
                 'No escalation ladder has been configured.')
 
-        level = max(-1, self.current_level + diff)
+        level = self.__add_level(diff)
         new_rung = get_rung(level, config)
 
         actions = proto.ActionSet()
@@ -80,7 +89,6 @@ class UserEscalationHistory:
                 action = actions.action.add()
                 action.CopyFrom(rung_action)
                 self.__setup_action(action, reason)
-                await self.bot.action_manager.execute(action)
         else:
             action = actions.action.add()
             action.escalate.amount = diff
@@ -89,10 +97,16 @@ class UserEscalationHistory:
         entry = self.__create_entry(authorizer, new_rung, diff)
         entry.action = actions
         self.session.add(entry)
+        if self._entries is not None:
+            self._entries.append(entry)
 
         expiration = self.__schedule_deescalation(new_rung, entry)
 
         self.session.commit()
+        if execute:
+            await self.bot.action_manager.sequentially_execute(actions.action)
+        if expiration is not None:
+            self.bot.dispatch('deescalation_scheduled', expiration)
 
         result = EscalationResult(
             entry=entry, current_rung=new_rung,
@@ -144,7 +158,7 @@ class UserEscalationHistory:
         return expiration
 
     def __create_entry(self, authorizer, rung, level_delta):
-        authorizer_name = f"{authorizer.name}#{authorizer.discriminator}",
+        authorizer_name = f"{authorizer.name}#{authorizer.discriminator}"
         display_name = (rung.display_name if level_delta >= 0 else
                         'Deescalate')
         return models.EscalationEntry(
@@ -161,6 +175,42 @@ class UserEscalationHistory:
         action.guild_id = self.guild.id
         action.reason = reason
 
+    def __get_level(self):
+        if self._level is None:
+            self._level = self.session.query(models.EscalationLevel) \
+                                      .get((self.guild.id, self.user_id))
+        if self._level is None:
+            # Replay any history recorded before levels were stored.
+            level = -1
+            for entry in self.entries:
+                level = max(-1, level + entry.level_delta)
+            self._level = models.EscalationLevel(
+                guild_id=self.guild.id, subject_id=self.user_id, level=level)
+        return self._level
+
+    def __add_level(self, diff):
+        """Adds diff to the user's level, which cannot go below -1, and
+        returns the new level.
+
+        The level is changed with a single upsert, so concurrent escalations
+        of the same user are applied one after another instead of
+        overwriting each other. The row stays locked until the session is
+        committed.
+        """
+        table = models.EscalationLevel.__table__
+        insert = postgresql.insert(table).values(
+            guild_id=self.guild.id, subject_id=self.user_id,
+            level=max(-1, self.current_level + diff))
+        insert = insert.on_conflict_do_update(
+            index_elements=[table.c.guild_id, table.c.subject_id],
+            set_={'level': func.greatest(-1, table.c.level + diff)})
+        level = self.session.execute(
+            insert.returning(table.c.level)).scalar()
+        if self._level in self.session:
+            self.session.expire(self._level)
+        self._level = None
+        return level
+
     def __query_history(self):
         return self.session.query(models.EscalationEntry) \
                            .filter_by(guild_id=self.guild.id,
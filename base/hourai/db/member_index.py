@@ -0,0 +1,283 @@
+import asyncio
+import coders
+import collections
+import logging
+from hourai.utils import iterable
+from .redis_utils import redis_transaction, redis_expire_all
+
+log = logging.getLogger(__name__)
+
+GUILD_MEMBERSHIP_PREFIX = 0
+GUILD_BOOSTER_PREFIX = 1
+GUILD_MEMBERS_PREFIX = 2
+
+# Seconds until a mirrored entry that no process refreshes expires. Covers
+# guilds left and members removed while no process was watching them.
+MEMBER_INDEX_TTL = 6 * 60 * 60
+# Seconds between refreshes of the expiration of the locally known entries.
+MEMBER_INDEX_REFRESH_INTERVAL = MEMBER_INDEX_TTL // 3
+# Maximum number of members or keys written per Redis round trip when
+# rebuilding, clearing, or refreshing the mirrored index.
+MEMBER_INDEX_CHUNK_SIZE = 1000
+
+
+class MemberIndex:
+    """A reverse index from user IDs to the IDs of the guilds they are in, and
+    of the guilds they are boosting. Kept up to date from member and guild
+    events, and only contains members that have been seen by this process.
+
+    If redis is provided, the index is also mirrored to Redis, which makes
+    memberships seen by other processes available through fetch_guild_ids.
+    Only changes to the local index are written, in batched pipelines. Each
+    guild's members are also mirrored, so that the guild can be rebuilt when
+    it becomes available and cleared when it is removed. Mirrored entries
+    expire unless the process serving the guild keeps refreshing them.
+    """
+
+    def __init__(self, redis=None, prefix=None):
+        self.redis = redis
+        self._guilds = collections.defaultdict(set)
+        self._boosting = collections.defaultdict(set)
+        self._guild_ids = set()
+
+        if redis is not None:
+            assert prefix is not None
+            self._key_coders = {
+                subprefix: coders.IntCoder().prefixed(
+                    bytes([prefix, subprefix]))
+                for subprefix in (GUILD_MEMBERSHIP_PREFIX,
+                                  GUILD_BOOSTER_PREFIX,
+                                  GUILD_MEMBERS_PREFIX)
+            }
+            self._id_coder = coders.IntCoder()
+        # Pending Redis writes: (command, key, member) tuples.
+        self._pending = []
+        self._flush_task = None
+        self._refresh_task = None
+
+    def get_guild_ids(self, user_id):
+        """Gets the IDs of the guilds a user is known to be in by this
+        process. O(1) time.
+        """
+        return frozenset(self._guilds.get(user_id, ()))
+
+    def is_booster(self, user_id):
+        """Checks if a user is known to boost any guild. O(1) time."""
+        return len(self._boosting.get(user_id, ())) > 0
+
+    async def fetch_guild_ids(self, user_id):
+        """|coro| Gets the IDs of the guilds a user is known to be in by any
+        process. Only includes this process if not mirrored to Redis.
+        """
+        guild_ids = self.get_guild_ids(user_id)
+        if self.redis is None:
+            return guild_ids
+        key_coder = self._key_coders[GUILD_MEMBERSHIP_PREFIX]
+        shared = await self.redis.smembers(key_coder.encode(user_id))
+        shared = set(self._id_coder.decode(guild_id)
+                     for guild_id in shared or ()) - guild_ids
+        return guild_ids.union(await self.__filter_live_guilds(shared))
+
+    async def __filter_live_guilds(self, guild_ids):
+        # Drop guilds whose members are no longer mirrored by any process.
+        guild_ids = list(guild_ids)
+        if len(guild_ids) <= 0:
+            return ()
+        key_coder = self._key_coders[GUILD_MEMBERS_PREFIX]
+
+        def transaction(tr):
+            for guild_id in guild_ids:
+                yield tr.exists(key_coder.encode(guild_id))
+        exists = await redis_transaction(self.redis, transaction,
+                                         atomic=False)
+        return (guild_id for guild_id, found in zip(guild_ids, exists)
+                if found)
+
+    def add_member(self, member):
+        guild_id = member.guild.id
+        guilds = self._guilds[member.id]
+        if guild_id not in guilds:
+            guilds.add(guild_id)
+            self._queue('sadd', GUILD_MEMBERSHIP_PREFIX, member.id, guild_id)
+            self._queue('sadd', GUILD_MEMBERS_PREFIX, guild_id, member.id)
+        self.update_member(member)
+
+    def update_member(self, member):
+        guild_id = member.guild.id
+        boosting = self._boosting.get(member.id, ())
+        if member.premium_since is not None and guild_id not in boosting:
+            self._boosting[member.id].add(guild_id)
+            self._queue('sadd', GUILD_BOOSTER_PREFIX, member.id, guild_id)
+        elif member.premium_since is None and guild_id in boosting:
+            self.__discard(self._boosting, member.id, guild_id)
+            self._queue('srem', GUILD_BOOSTER_PREFIX, member.id, guild_id)
+
+    def remove_member(self, member):
+        self.__remove(member.id, member.guild.id)
+
+    def add_guild(self, guild):
+        """Indexes every member of a guild. If mirrored to Redis, the guild's
+        mirrored entries are rebuilt, dropping members removed while no
+        process was watching the guild.
+        """
+        self._guild_ids.add(guild.id)
+        for member in guild.members:
+            self._guilds[member.id].add(guild.id)
+            if member.premium_since is not None:
+                self._boosting[member.id].add(guild.id)
+            else:
+                self.__discard(self._boosting, member.id, guild.id)
+        self._run(self._rebuild_guild(guild))
+
+    def remove_guild(self, guild):
+        """Removes every member of a guild from the index. If mirrored to
+        Redis, all of the guild's mirrored entries are deleted.
+        """
+        self._guild_ids.discard(guild.id)
+        for member in guild.members:
+            self.__discard(self._guilds, member.id, guild.id)
+            self.__discard(self._boosting, member.id, guild.id)
+        self._run(self._clear_guild(guild.id))
+
+    def __remove(self, user_id, guild_id):
+        if self.__discard(self._guilds, user_id, guild_id):
+            self._queue('srem', GUILD_MEMBERSHIP_PREFIX, user_id, guild_id)
+            self._queue('srem', GUILD_MEMBERS_PREFIX, guild_id, user_id)
+        if self.__discard(self._boosting, user_id, guild_id):
+            self._queue('srem', GUILD_BOOSTER_PREFIX, user_id, guild_id)
+
+    @staticmethod
+    def __discard(index, user_id, guild_id):
+        guilds = index.get(user_id)
+        if guilds is None or guild_id not in guilds:
+            return False
+        guilds.discard(guild_id)
+        if len(guilds) <= 0:
+            del index[user_id]
+        return True
+
+    def _queue(self, command, subprefix, key_id, member_id):
+        if self.redis is None:
+            return
+        key_coder = self._key_coders[subprefix]
+        self._pending.append((command, key_coder.encode(key_id),
+                              self._id_coder.encode(member_id)))
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush())
+        self.__start_refresh()
+
+    def _run(self, coro):
+        if self.redis is None:
+            coro.close()
+            return
+        asyncio.ensure_future(coro)
+        self.__start_refresh()
+
+    def __start_refresh(self):
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.ensure_future(self._refresh())
+
+    async def close(self):
+        """|coro| Stops refreshing the expiration of the mirrored index."""
+        if self._refresh_task is None:
+            return
+        self._refresh_task.cancel()
+        try:
+            await self._refresh_task
+        except asyncio.CancelledError:
+            pass
+        self._refresh_task = None
+
+    async def _flush(self):
+        # Let writes from the same event loop iteration join the batch.
+        await asyncio.sleep(0)
+        pending, self._pending = self._pending, []
+        self._flush_task = None
+
+        def transaction(tr):
+            added = set()
+            for command, key, member in pending:
+                yield getattr(tr, command)(key, member)
+                if command == 'sadd':
+                    added.add(key)
+            for key in added:
+                yield tr.expire(key, MEMBER_INDEX_TTL)
+        try:
+            await redis_transaction(self.redis, transaction, atomic=False)
+        except Exception:
+            log.exception('Failed to mirror member index to Redis:')
+
+    async def _rebuild_guild(self, guild):
+        try:
+            guild_key = self._key_coders[GUILD_MEMBERS_PREFIX].encode(guild.id)
+            mirrored = await self.redis.smembers(guild_key)
+            # Read the members only after the mirrored set, so that members
+            # that joined in between are not removed.
+            members = {member.id: member.premium_since is not None
+                       for member in guild.members}
+            departed = [user_id for user_id in
+                        (self._id_coder.decode(m) for m in mirrored or ())
+                        if user_id not in members]
+            for chunk in iterable.chunked(departed, MEMBER_INDEX_CHUNK_SIZE):
+                await self.__write_members(guild.id, chunk, None)
+            for chunk in iterable.chunked(members.items(),
+                                          MEMBER_INDEX_CHUNK_SIZE):
+                await self.__write_members(guild.id, chunk, True)
+            await self.redis.expire(guild_key, MEMBER_INDEX_TTL)
+        except Exception:
+            log.exception(f'Failed to rebuild member index of {guild.id}:')
+
+    async def _clear_guild(self, guild_id):
+        try:
+            guild_key = self._key_coders[GUILD_MEMBERS_PREFIX].encode(guild_id)
+            mirrored = await self.redis.smembers(guild_key)
+            user_ids = (self._id_coder.decode(m) for m in mirrored or ())
+            for chunk in iterable.chunked(user_ids, MEMBER_INDEX_CHUNK_SIZE):
+                await self.__write_members(guild_id, chunk, None)
+            await self.redis.delete(guild_key)
+        except Exception:
+            log.exception(f'Failed to clear member index of {guild_id}:')
+
+    async def __write_members(self, guild_id, members, present):
+        # If present, members is (user ID, is booster) pairs to add to the
+        # guild. Otherwise, it is user IDs to remove from the guild.
+        membership = self._key_coders[GUILD_MEMBERSHIP_PREFIX]
+        boosters = self._key_coders[GUILD_BOOSTER_PREFIX]
+        guild_key = self._key_coders[GUILD_MEMBERS_PREFIX].encode(guild_id)
+        guild_id = self._id_coder.encode(guild_id)
+
+        def transaction(tr):
+            if not present:
+                for user_id in members:
+                    yield tr.srem(membership.encode(user_id), guild_id)
+                    yield tr.srem(boosters.encode(user_id), guild_id)
+                    yield tr.srem(guild_key, self._id_coder.encode(user_id))
+                return
+            for user_id, is_booster in members:
+                key = membership.encode(user_id)
+                yield tr.sadd(key, guild_id)
+                yield tr.expire(key, MEMBER_INDEX_TTL)
+                key = boosters.encode(user_id)
+                if is_booster:
+                    yield tr.sadd(key, guild_id)
+                    yield tr.expire(key, MEMBER_INDEX_TTL)
+                else:
+                    yield tr.srem(key, guild_id)
+                yield tr.sadd(guild_key, self._id_coder.encode(user_id))
+        await redis_transaction(self.redis, transaction, atomic=False)
+
+    async def _refresh(self):
+        while True:
+            await asyncio.sleep(MEMBER_INDEX_REFRESH_INTERVAL)
+            keys = [self._key_coders[subprefix].encode(key_id)
+                    for subprefix, index in
+                    ((GUILD_MEMBERSHIP_PREFIX, self._guilds),
+                     (GUILD_BOOSTER_PREFIX, self._boosting),
+                     (GUILD_MEMBERS_PREFIX, self._guild_ids))
+                    for key_id in list(index)]
+            try:
+                for chunk in iterable.chunked(keys, MEMBER_INDEX_CHUNK_SIZE):
+                    await redis_expire_all(self.redis, chunk,
+                                           MEMBER_INDEX_TTL)
+            except Exception:
+                log.exception('Failed to refresh member index expiration:')
@@ -0,0 +1,202 @@
+import concurrent.futures
+import io
+import logging
+import time
+from sqlalchemy import column, func, select, table as raw_table, text, \
+    tuple_, type_coerce, types
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 10000
+DEFAULT_WORKERS = 4
+
+
+def move_tables(tables, src_engine, dst_engine, *,
+                chunk_size=DEFAULT_CHUNK_SIZE, workers=DEFAULT_WORKERS):
+    """Copies every row of tables from src_engine to dst_engine.
+
+    Rows are streamed in chunks of chunk_size with a server-side cursor, so
+    memory use does not depend on the size of the tables. Postgres
+    destinations are written to with COPY, others with executemany.
+
+    Tables are copied in parallel with up to workers threads, but never
+    before the tables they reference through foreign keys. Each chunk is
+    committed on its own. Tables that already have rows in the destination
+    are resumed after their last copied primary key.
+    """
+    tables = list(tables)
+    if dst_engine.dialect.name == 'sqlite' and workers > 1:
+        log.info('SQLite only supports a single writer. Copying tables '
+                 'sequentially.')
+        workers = 1
+
+    remaining = {tbl: _get_dependencies(tbl, tables) for tbl in tables}
+    done = set()
+    start = time.monotonic()
+    total_rows = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        running = {}
+        while remaining or running:
+            ready = [tbl for tbl, deps in remaining.items() if deps <= done]
+            for tbl in ready:
+                del remaining[tbl]
+                running[pool.submit(_move_table, tbl, src_engine,
+                                    dst_engine, chunk_size)] = tbl
+            if not running:
+                raise ValueError(f'Circular foreign keys between tables: '
+                                 f'{[tbl.name for tbl in remaining]}')
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                total_rows += future.result()
+                done.add(running.pop(future))
+
+    elapsed = time.monotonic() - start
+    log.info(f'Moved {total_rows} rows from {len(tables)} tables in '
+             f'{elapsed:.2f} seconds.')
+    return total_rows
+
+
+def _get_dependencies(tbl, tables):
+    return set(fk.column.table for fk in tbl.foreign_keys
+               if fk.column.table in tables and fk.column.table is not tbl)
+
+
+def _move_table(tbl, src_engine, dst_engine, chunk_size):
+    # Bypass any TypeDecorators so values are copied exactly as stored.
+    columns = [_raw_column(col) for col in tbl.c]
+    dst_table = raw_table(tbl.name, *[column(col.name, col.type)
+                                      for col in columns])
+    primary_key = list(tbl.primary_key.columns)
+
+    query = select(columns)
+    with src_engine.connect() as src_conn:
+        total = src_conn.execute(select([func.count()]).select_from(tbl)) \
+                        .scalar()
+        copied = _prepare_destination(tbl, primary_key, total, dst_engine)
+        if copied >= total:
+            log.info(f'[{tbl.name}] {copied}/{total} rows already moved.')
+            return 0
+        if copied > 0:
+            last_key = _get_last_key(primary_key, dst_engine)
+            query = query.where(tuple_(*primary_key) > tuple_(*last_key))
+            log.info(f'[{tbl.name}] Resuming after {copied} rows.')
+        if len(primary_key) > 0:
+            query = query.order_by(*primary_key)
+
+        start = time.monotonic()
+        moved = 0
+        result = src_conn.execution_options(stream_results=True) \
+                         .execute(query)
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            _write_rows(dst_engine, dst_table, rows)
+            moved += len(rows)
+            rate = moved / max(time.monotonic() - start, 1e-6)
+            log.info(f'[{tbl.name}] {copied + moved}/{total} rows '
+                     f'({rate:.0f} rows/s).')
+
+    _reset_sequence(tbl, dst_engine)
+    return moved
+
+
+def _raw_column(col):
+    if isinstance(col.type, types.TypeDecorator):
+        return type_coerce(col, col.type.impl).label(col.name)
+    return col
+
+
+def _prepare_destination(tbl, primary_key, total, dst_engine):
+    """Returns the number of rows already copied to the destination table.
+    Tables without a primary key cannot be resumed and are cleared.
+    """
+    with dst_engine.connect() as dst_conn:
+        copied = dst_conn.execute(select([func.count()]).select_from(tbl)) \
+                         .scalar()
+        if 0 < copied < total and len(primary_key) <= 0:
+            log.info(f'[{tbl.name}] Cannot resume without a primary key. '
+                     f'Clearing {copied} copied rows.')
+            dst_conn.execute(tbl.delete())
+            copied = 0
+    return copied
+
+
+def _get_last_key(primary_key, dst_engine):
+    with dst_engine.connect() as dst_conn:
+        query = select(primary_key) \
+            .order_by(*[col.desc() for col in primary_key]) \
+            .limit(1)
+        return tuple(dst_conn.execute(query).first())
+
+
+def _write_rows(dst_engine, dst_table, rows):
+    if dst_engine.dialect.name == 'postgresql':
+        _copy_rows(dst_engine, dst_table, rows)
+        return
+    with dst_engine.begin() as dst_conn:
+        dst_conn.execute(dst_table.insert(), [dict(row) for row in rows])
+
+
+def _copy_rows(dst_engine, dst_table, rows):
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join(_to_copy_text(value) for value in row))
+        buf.write('\n')
+    buf.seek(0)
+
+    column_names = ', '.join(f'"{col.name}"' for col in dst_table.c)
+    conn = dst_engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.copy_expert(f'COPY "{dst_table.name}" ({column_names}) '
+                               f'FROM STDIN', buf)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def _to_copy_text(value):
+    """Encodes a value in Postgres's COPY text format."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        value = '\\x' + bytes(value).hex()
+    elif isinstance(value, (list, tuple)):
+        value = _to_array_literal(value)
+    else:
+        value = str(value)
+    return value.replace('\\', '\\\\') \
+                .replace('\t', '\\t') \
+                .replace('\n', '\\n') \
+                .replace('\r', '\\r')
+
+
+def _to_array_literal(values):
+    def encode(value):
+        if value is None:
+            return 'NULL'
+        if isinstance(value, (int, float)):
+            return str(value)
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+        return f'"{value}"'
+    return '{' + ','.join(encode(value) for value in values) + '}'
+
+
+def _reset_sequence(tbl, dst_engine):
+    """Points the sequence of a serial primary key past the copied rows, as
+    COPY and explicit inserts do not advance it.
+    """
+    col = tbl._autoincrement_column
+    if dst_engine.dialect.name != 'postgresql' or col is None:
+        return
+    with dst_engine.begin() as dst_conn:
+        dst_conn.execute(
+            text(f"SELECT setval(pg_get_serial_sequence(:table, :column), "
+                 f"COALESCE(MAX(\"{col.name}\"), 0) + 1, false) "
+                 f"FROM \"{tbl.name}\""),
+            table=tbl.name, column=col.name)
@@ -24,9 +24,13 @@ class UnixTimestamp(types.TypeDecorator):
         types.TypeDecorator.__init__(self)
 
     def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
         return int(value.replace(tzinfo=timezone.utc).timestamp() * 1000)
 
     def process_result_value(self, value, dialect):
+        if value is None:
+            return None
         return datetime.utcfromtimestamp(value / 1000)
 
 
@@ -61,8 +65,11 @@ class PendingAction(Base):
     __tablename__ = 'pending_actions'
 
     id = Column(types.Integer, primary_key=True)
-    timestamp = Column(UnixTimestamp, nullable=False)
+    timestamp = Column(UnixTimestamp, nullable=False, index=True)
     data = Column(Protobuf(proto.Action), nullable=False)
+    # Set while a worker is executing the action. Other workers may claim it
+    # again once it passes.
+    lease_expiration = Column(UnixTimestamp)
 
 
 class Tag(Base):
@@ -87,6 +94,23 @@ class EscalationEntry(Base):
     level_delta = Column(types.Integer, nullable=False)
 
 
+Index("idx_escalation_history_guild_subject", EscalationEntry.guild_id,
+      EscalationEntry.subject_id, EscalationEntry.timestamp)
+
+
+class EscalationLevel(Base):
+    """The current escalation level of a user in a guild. Updated with every
+    EscalationEntry, so the level does not need to be replayed from the full
+    history.
+    """
+    __tablename__ = 'escalation_levels'
+
+    guild_id = Column(types.BigInteger, primary_key=True, autoincrement=False)
+    subject_id = Column(types.BigInteger, primary_key=True,
+                        autoincrement=False)
+    level = Column(types.Integer, nullable=False)
+
+
 class PendingDeescalation(Base):
     __tablename__ = 'pending_deescalations'
 
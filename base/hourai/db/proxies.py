@@ -152,27 +152,30 @@ class InviteCache:
 
 
 class ConfigCache:
+    """Accessor for a guild's configs.
 
-    __slots__ = ('storage', 'guild', '_cache')
+    Values are served from the storage's local caches, which revalidate
+    against the guild's config version in Redis, so changes made by other
+    processes are picked up. The bot sizes the local caches to hold the
+    configs of every guild it serves, see Storage.resize_config_caches.
+    """
+
+    __slots__ = ('storage', 'guild')
 
     def __init__(self, storage, guild):
         self.storage = storage
         self.guild = guild
-        self._cache = {}
 
     async def get(self, name):
         name = name.lower()
-        if name not in self._cache:
-            cache = getattr(self.storage, name + '_configs')
-            conf = await cache.get(self.guild.id)
-            self._cache[name] = conf or DEFAULT_TYPES[name]()
-        return self._cache[name]
+        cache = getattr(self.storage, name + '_configs')
+        conf = await cache.get(self.guild.id)
+        return conf or DEFAULT_TYPES[name]()
 
     async def set(self, name, cfg):
         name = name.lower()
         cache = getattr(self.storage, name + '_configs')
         await cache.set(self.guild.id, cfg)
-        self._cache[name] = cfg
 
 
 class GuildProxy:
@@ -2,8 +2,19 @@ import aioredis
 import asyncio
 import logging
 
+# Maximum number of attempts of an optimistic transaction.
+MAX_WATCH_ATTEMPTS = 5
 
-async def redis_transaction(redis, txn_func):
+
+async def redis_transaction(redis, txn_func, *, atomic=True):
+    """|coro| Runs the commands yielded by txn_func in a single round trip.
+
+    If atomic is True, the commands are wrapped in MULTI/EXEC. Otherwise they
+    are sent as a plain pipeline, which avoids the transaction overhead and is
+    preferable for read-only batches that do not need isolation.
+    """
+    if not atomic:
+        return await redis_pipeline(redis, txn_func)
     try:
         tr = redis.multi_exec()
         futs = list(txn_func(tr))
@@ -13,3 +24,72 @@ async def redis_transaction(redis, txn_func):
     except aioredis.MultiExecError:
         logging.exception('Failure in Redis Transaction:')
         raise
+
+
+async def redis_watch_transaction(redis, keys, prepare, *,
+                                  max_attempts=MAX_WATCH_ATTEMPTS):
+    """|coro| Runs an optimistic read-modify-write transaction.
+
+    WATCHes keys on a dedicated connection and awaits prepare(conn), which
+    reads them and returns a txn_func as for redis_transaction, or None if
+    there is nothing to write. If any of the keys change before the
+    transaction commits, it is retried from prepare. Returns the results of
+    the transaction, or None if nothing was written.
+    """
+    for _ in range(max_attempts):
+        with await redis as conn:
+            await conn.watch(*keys)
+            txn_func = await prepare(conn)
+            if txn_func is None:
+                await conn.unwatch()
+                return None
+            tr = conn.multi_exec()
+            futs = list(txn_func(tr))
+            try:
+                return await tr.execute()
+            except aioredis.MultiExecError as error:
+                # Consume the failed command results.
+                await asyncio.gather(*futs, return_exceptions=True)
+                if not _is_watch_failure(error):
+                    raise
+    raise aioredis.WatchVariableError(
+        f'Keys changed in all {max_attempts} attempts: {keys}')
+
+
+def _is_watch_failure(error):
+    errors = error.args[1] if len(error.args) > 1 else ()
+    return len(errors) > 0 and \
+        all(isinstance(err, aioredis.WatchVariableError) for err in errors)
+
+
+async def redis_pipeline(redis, txn_func):
+    """|coro| Runs the commands yielded by txn_func as a non-transactional
+    pipeline. Returns the list of results in command order.
+    """
+    try:
+        pipe = redis.pipeline()
+        for _ in txn_func(pipe):
+            pass
+        return await pipe.execute()
+    except aioredis.PipelineError:
+        logging.exception('Failure in Redis Pipeline:')
+        raise
+
+
+# Sets the same expiration on every key passed in, in a single command.
+_EXPIRE_ALL_SCRIPT = """
+for _, key in ipairs(KEYS) do
+    redis.call('EXPIRE', key, ARGV[1])
+end
+return #KEYS
+"""
+
+
+async def redis_expire_all(redis, keys, timeout):
+    """|coro| Sets the expiration of every key in keys to timeout seconds in
+    one round trip, instead of one EXPIRE per key. Missing keys are ignored.
+    """
+    keys = list(keys)
+    if len(keys) <= 0:
+        return 0
+    return await redis.eval(_EXPIRE_ALL_SCRIPT, keys=keys, args=[timeout])
@@ -4,10 +4,15 @@ import collections
 import enum
 import coders
 import logging
+import threading
+import time
 from concurrent.futures import ThreadPoolExecutor
-from sqlalchemy import create_engine, orm, pool
+from sqlalchemy import create_engine, exc, inspect, orm, pool
+from sqlalchemy.schema import CreateColumn
 from hourai import config
-from . import models, caches, proto, bans
+from hourai.utils import iterable
+from . import models, admin_configs, caches, compression, proto, bans
+from .member_index import MemberIndex
 
 log = logging.getLogger(__name__)
 
@@ -18,6 +23,29 @@ CacheConfig = collections.namedtuple(
     defaults=(None,) * 7)
 
 
+# Window, in seconds, in which concurrent Redis reads are merged into a single
+# batch. 0 batches reads issued in the same event loop iteration.
+REDIS_BATCH_WINDOW = 0
+# Age, in seconds, after which locally cached configs are refreshed from Redis
+# in the background while the cached value continues to be served.
+CONFIG_CACHE_REFRESH_TTL = 5 * 60
+# Number of guilds loaded per pipelined round trip when prefetching configs.
+CONFIG_PREFETCH_BATCH_SIZE = 1000
+# Local config cache slots kept per guild served by the process. Leaves room
+# for guilds joined between resizes.
+CONFIG_CACHE_HEADROOM = 1.25
+# Maximum number of SQL queries run concurrently off of the event loop.
+SQL_EXECUTOR_WORKERS = 8
+# Defaults for the database_pool config values.
+SQL_POOL_DEFAULTS = {
+    'size': SQL_EXECUTOR_WORKERS,
+    'max_overflow': SQL_EXECUTOR_WORKERS,
+    'timeout': 30,
+    'recycle': 30 * 60,
+    'pre_ping': True,
+}
+
+
 def protobuf(msg_type):
     return lambda: coders.ProtobufCoder(msg_type)
 
@@ -29,6 +57,9 @@ class StoragePrefix(enum.Enum):
     GUILD_CONFIGS = 1
     # Cached bans. Ephemeral data that have expirations assigned to them.
     BANS = 2
+    # Reverse index of the guilds each user is in. Only used if shared between
+    # processes.
+    MEMBERS = 3
 
 
 class GuildPrefix(enum.Enum):
@@ -55,6 +86,49 @@ def _prefixize(val):
     return val
 
 
+# Hash field under each guild config key holding a version number that is
+# incremented on every config write. Must not be used by any GuildPrefix.
+GUILD_CONFIG_VERSION_FIELD = _prefixize(255)
+
+
+class InstrumentedQueuePool(pool.QueuePool):
+    """A QueuePool that records how many checkouts were made, how long they
+    waited for a connection and how many timed out.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.counters = collections.Counter()
+        self._counter_lock = threading.Lock()
+
+    def _do_get(self):
+        start = time.monotonic()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            log.warning(f'Timed out waiting for a SQL connection: '
+                        f'{self.status()}')
+            raise
+        finally:
+            with self._counter_lock:
+                self.counters['checkouts'] += 1
+                self.counters['checkout_wait'] += time.monotonic() - start
+                self.counters['timeouts'] += timed_out
+
+    def stats(self):
+        """Returns a Counter of the pool's checkout counters along with its
+        current size, in-use and overflow connection counts.
+        """
+        with self._counter_lock:
+            stats = collections.Counter(self.counters)
+        stats['size'] = self.size()
+        stats['in_use'] = self.checkedout()
+        stats['overflow'] = max(self.overflow(), 0)
+        return stats
+
+
 class Storage:
     """A generic interface for managing the remote storage services connected to
     the bot.
@@ -63,8 +137,14 @@ class Storage:
     def __init__(self, config_module=config):
         self.config = config_module
         self.session_class = None
+        self.sql_engine = None
         self.redis = None
-        self.executor = ThreadPoolExecutor()
+        self.cache_invalidator = None
+        self.compression_coder = None
+        self.admin_configs = None
+        self.member_index = None
+        self.executor = ThreadPoolExecutor(
+            max_workers=SQL_EXECUTOR_WORKERS, thread_name_prefix='hourai-sql')
         for conf in Storage._get_cache_configs():
             setattr(self, conf.attr, None)
 
@@ -78,8 +158,9 @@ class Storage:
         try:
             log.info('Initializing connection to SQL database...')
             engine = self._create_sql_engine()
+            self.sql_engine = engine
             self.session_class = orm.sessionmaker(bind=engine)
-            self.ensure_created()
+            self.ensure_created(engine)
             log.info('SQL database connection established.')
         except Exception:
             log.exception('Error when initializing SQL database:')
@@ -91,7 +172,9 @@ class Storage:
             redis_conf = config.get_config_value(self.config, 'redis',
                                                  type=str)
             await self._connect_to_redis(redis_conf)
+            self.cache_invalidator = caches.CacheInvalidator(self.redis)
             self.__setup_caches()
+            self.cache_invalidator.start()
             log.info('Redis connection established.')
         except Exception:
             log.exception('Error when initializing Redis:')
@@ -114,19 +197,41 @@ class Storage:
                 await asyncio.sleep(wait_time)
                 wait_time *= 2
 
+    def _create_compression_coder(self):
+        path = config.get_config_value(self.config, 'compression_dictionary',
+                                       default='')
+        zstd_dict = None
+        if path:
+            with open(path, 'rb') as f:
+                zstd_dict = f.read()
+            log.info(f'Loaded compression dictionary from {path}.')
+        return compression.AdaptiveCompressionCoder(zstd_dict=zstd_dict)
+
     def __setup_caches(self):
-        self.bans = bans.BanStorage(self, StoragePrefix.BANS.value)
+        self.compression_coder = self._create_compression_coder()
+        self.bans = bans.BanStorage(self, StoragePrefix.BANS.value,
+                                    invalidator=self.cache_invalidator)
+        self.admin_configs = admin_configs.AdminConfigTable(
+            self, invalidator=self.cache_invalidator)
+        if config.get_config_value(self.config, 'share_member_index',
+                                   default=False):
+            self.member_index = MemberIndex(self.redis,
+                                            StoragePrefix.MEMBERS.value)
+        else:
+            self.member_index = MemberIndex()
 
         for conf in Storage._get_cache_configs():
             # Initialize Parameters
             prefix = _prefixize(conf.prefix.value)
             key_coder = coders.IntCoder().prefixed(prefix)
             value_coder = (conf.value_coder or protobuf(conf.proto_type))()
-            value_coder = value_coder.compressed()
+            value_coder = value_coder.then(self.compression_coder)
 
             timeout = conf.timeout or 0
             if conf.subprefix is None:
-                store = caches.RedisStore(self.redis, timeout=timeout)
+                store = caches.RedisStore(
+                    self.redis, timeout=timeout,
+                    batch_window=REDIS_BATCH_WINDOW)
             else:
                 subprefix = _prefixize(conf.subprefix)
                 subcoder = coders.ConstCoder(subprefix)
@@ -134,16 +239,21 @@ class Storage:
                     subcoder = conf.subcoder.prefixed(subprefix)
 
                 key_coder = coders.TupleCoder([key_coder, subcoder])
-                store = caches.RedisHashStore(self.redis, timeout=timeout)
+                store = caches.RedisHashStore(
+                    self.redis, timeout=timeout,
+                    batch_window=REDIS_BATCH_WINDOW,
+                    version_field=GUILD_CONFIG_VERSION_FIELD)
 
             cache = caches.Cache(store,
                                  key_coder=key_coder,
-                                 value_coder=value_coder)
+                                 value_coder=value_coder,
+                                 name=conf.attr,
+                                 invalidator=self.cache_invalidator,
+                                 invalidation_key_coder=coders.IntCoder(),
+                                 refresh_ttl=CONFIG_CACHE_REFRESH_TTL)
             setattr(self, conf.attr, cache)
 
-        # TODO(james7132): Uncomment the above once AggregateProtoHashCache
-        # supports client side caching
-        mapping = []
+        entries = []
         for conf in Storage._get_cache_configs():
             if conf.prefix != StoragePrefix.GUILD_CONFIGS:
                 continue
@@ -151,9 +261,15 @@ class Storage:
             attr = conf.attr
             if '_configs' in attr:
                 attr = attr.replace('_configs', '')
-            mapping.append((attr, getattr(self, conf.attr)))
-        self.guild_configs = caches.AggregateProtoCache(proto.GuildConfig,
-                                                        mapping)
+            entries.append(caches.AggregateProtoHashCache.Entry(
+                field=_prefixize(conf.subprefix), field_name=attr,
+                cache=getattr(self, conf.attr)))
+        prefix = _prefixize(StoragePrefix.GUILD_CONFIGS.value)
+        self.guild_configs = caches.AggregateProtoHashCache(
+            self.redis, proto.GuildConfig, entries=entries,
+            key_coder=coders.IntCoder().prefixed(prefix),
+            batch_window=REDIS_BATCH_WINDOW,
+            version_field=GUILD_CONFIG_VERSION_FIELD)
 
     @staticmethod
     def _get_cache_configs():
@@ -163,36 +279,163 @@ class Storage:
                    for conf in configs]
         return configs
 
-    def create_session(self):
-        return StorageSession(self)
+    @property
+    def config_cache_size(self):
+        """The number of guilds whose configs fit in the local caches."""
+        return min(entry.cache.local_cache.max_size
+                   for entry in self.guild_configs.entries)
+
+    def resize_config_caches(self, guild_count):
+        """Grows the local config caches to hold the configs of guild_count
+        guilds, so configs of served guilds are not evicted by each other.
+        Never shrinks them.
+        """
+        size = int(guild_count * CONFIG_CACHE_HEADROOM)
+        for conf in Storage._get_cache_configs():
+            local_cache = getattr(self, conf.attr).local_cache
+            local_cache.max_size = max(local_cache.max_size, size)
+
+    async def prefetch_guild_configs(self, guild_ids, limit=None,
+                                     name='guilds'):
+        """|coro| Warms the local config caches for multiple guilds with large
+        pipelined reads. Guilds should be ordered by priority, as at most
+        limit guilds are loaded. limit defaults to config_cache_size.
+        """
+        guild_ids = list(guild_ids)
+        if limit is None:
+            limit = self.config_cache_size
+        if len(guild_ids) > limit:
+            log.warning(f'Local config caches are too small to prefetch all '
+                        f'{len(guild_ids)} {name}. Prefetching {limit}.')
+            guild_ids = guild_ids[:limit]
+
+        log.info(f'Prefetching configs for {len(guild_ids)} {name}...')
+        start = time.monotonic()
+        done = fetched = 0
+        for batch in iterable.chunked(guild_ids, CONFIG_PREFETCH_BATCH_SIZE):
+            done += len(batch)
+            fetched += await self.guild_configs.prefetch(batch)
+            log.info(f'Prefetched configs for {done}/{len(guild_ids)} '
+                     f'{name}.')
+        log.info(f'Prefetched configs for {len(guild_ids)} {name} in '
+                 f'{time.monotonic() - start:.2f} seconds. {fetched} were '
+                 f'not already cached.')
+
+    def cache_stats(self):
+        """Returns the local cache statistics of every config cache, keyed by
+        the cache's name.
+        """
+        return {conf.attr: getattr(self, conf.attr).stats()
+                for conf in Storage._get_cache_configs()}
+
+    def sql_pool_stats(self):
+        """Returns the SQL connection pool statistics, or None if the pool is
+        not instrumented.
+        """
+        engine_pool = getattr(self.sql_engine, 'pool', None)
+        if not isinstance(engine_pool, InstrumentedQueuePool):
+            return None
+        return engine_pool.stats()
+
+    def create_session(self, **kwargs):
+        return StorageSession(self, **kwargs)
+
+    async def run_in_session(self, func, *args):
+        """|coro| Runs func(session, *args) with a new StorageSession on the
+        SQL executor, without blocking the event loop. The session is
+        committed if func returns normally, rolled back otherwise, and closed
+        before returning func's result.
+
+        Loaded objects are not expired on commit, so returned models can be
+        read, but not lazily loaded, after the session is closed.
+        """
+        def run():
+            with self.create_session(expire_on_commit=False) as session:
+                return func(session, *args)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, run)
 
     async def close(self):
+        if self.member_index is not None:
+            await self.member_index.close()
+        if self.cache_invalidator is not None:
+            await self.cache_invalidator.close()
         self.redis.close()
+        self.executor.shutdown(wait=False)
 
     def ensure_created(self, engine=None):
         engine = engine or self._create_sql_engine()
         models.Base.metadata.create_all(engine)
+        self.__ensure_columns(engine)
+        self.__ensure_indexes(engine)
+
+    def __ensure_columns(self, engine):
+        """Adds nullable columns that were added to tables after they were
+        first created, which create_all does not do.
+
+        This is not a migration tool: it only ever adds nullable columns,
+        never alters or drops them, and only issues DDL when a column is
+        missing. Anything more involved must be migrated by hand.
+        """
+        inspector = inspect(engine)
+        for table in models.Base.metadata.sorted_tables:
+            existing = set(column['name']
+                           for column in inspector.get_columns(table.name))
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                assert column.nullable, \
+                    f'Cannot add non-nullable column: {column}'
+                log.info(f'Creating missing column: {column}')
+                ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                engine.execute(f'ALTER TABLE {table.name} ADD COLUMN {ddl}')
+
+    def __ensure_indexes(self, engine):
+        """Creates indexes that were added to tables after they were first
+        created, which create_all does not do.
+        """
+        inspector = inspect(engine)
+        for table in models.Base.metadata.sorted_tables:
+            existing = set(index['name']
+                           for index in inspector.get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in existing:
+                    log.info(f'Creating missing index: {index.name}')
+                    index.create(engine)
 
     def _create_sql_engine(self, connection_str=None):
         connection_str = connection_str or \
             config.get_config_value(self.config, 'database', type=str)
 
-        connect_args = dict()
         if 'sqlite' in connection_str:
-            connect_args['check_same_thread'] = False
+            # SQLite picks its own pool based on whether the database is in
+            # memory or on disk.
+            return create_engine(connection_str,
+                                 connect_args={'check_same_thread': False})
+
+        def pool_value(name):
+            # Configs are conformed to the template, which fills keys
+            # missing from a partial database_pool section with None.
+            value = config.get_config_value(
+                self.config, f'database_pool.{name}', default=None)
+            return SQL_POOL_DEFAULTS[name] if value is None else value
 
         return create_engine(connection_str,
-                             poolclass=pool.SingletonThreadPool,
-                             client_encoding='utf8',
-                             connect_args=connect_args)
+                             poolclass=InstrumentedQueuePool,
+                             pool_size=pool_value('size'),
+                             max_overflow=pool_value('max_overflow'),
+                             pool_timeout=pool_value('timeout'),
+                             pool_recycle=pool_value('recycle'),
+                             pool_pre_ping=pool_value('pre_ping'),
+                             client_encoding='utf8')
 
 
 class StorageSession:
     __slots__ = ['storage', 'db_session', 'redis', 'subitems']
 
-    def __init__(self, storage):
+    def __init__(self, storage, **kwargs):
         self.storage = storage
-        self.db_session = storage.session_class()
+        self.db_session = storage.session_class(**kwargs)
         self.redis = storage.redis
 
         self.subitems = (self.db_session, self.storage)
@@ -212,7 +455,12 @@ class StorageSession:
         self.db_session.close()
 
     async def execute_query(self, callback, *args):
-        return await asyncio.run_in_executor(self.executor, callback, *args)
+        """|coro| Runs callback(*args) on the SQL executor. The session must
+        not be used concurrently by anything else until it completes. Prefer
+        Storage.run_in_session.
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, callback, *args)
 
     def __getattr__(self, attr):
         for subitem in self.subitems:
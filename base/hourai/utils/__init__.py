@@ -228,9 +228,7 @@ def is_nitro_booster(bot, member):
     """Checks if the user is boosting any server the bot is on."""
     if member is None:
         return False
-    return any(m.id == member.id
-               for g in bot.guilds
-               for m in g.premium_subscribers)
+    return bot.storage.member_index.is_booster(member.id)
 
 
 def has_nitro(bot, member):
@@ -48,17 +48,17 @@ def traceback_to_embed(keep_end=False):
     return text_to_embed(text, keep_end=keep_end)
 
 
-def make_whois_embed(ctx, user):
+async def make_whois_embed(ctx, user):
     now = datetime.utcnow()
 
     description = []
 
-    guild_count = _get_guild_count(ctx, user)
+    guild_count = await _get_guild_count(ctx, user)
     if guild_count > 1:
         count = format.bold(str(guild_count))
         description.append(f'Seen on {count} servers.')
 
-    usernames = _get_extra_usernames(ctx, user)
+    usernames = await _get_extra_usernames(ctx, user)
     if len(usernames) > 0:
         output = reversed([_to_username_line(un) for un in usernames])
         description.append(format.multiline_code(format.vertical_list(output)))
@@ -113,18 +113,20 @@ def _to_username_line(username):
     return f'{date_string} {user_string}'
 
 
-def _get_guild_count(ctx, user):
+async def _get_guild_count(ctx, user):
     # FIXME: This may be broken when fetch_offline_members is set to False
-    # FIXME: This will not work when the bot grows larger than one process.
-    return sum(1 if g.get_member(user.id) is not None else 0
-               for g in ctx.bot.guilds)
-
-
-def _get_extra_usernames(ctx, user):
-    usernames = ctx.session.query(models.Username) \
-        .filter_by(user_id=user.id) \
-        .order_by(models.Username.timestamp) \
-        .limit(20)
+    guild_ids = await ctx.bot.storage.member_index.fetch_guild_ids(user.id)
+    return len(guild_ids)
+
+
+async def _get_extra_usernames(ctx, user):
+    def query(session):
+        return session.query(models.Username) \
+            .filter_by(user_id=user.id) \
+            .order_by(models.Username.timestamp) \
+            .limit(20) \
+            .all()
+    usernames = await ctx.bot.storage.run_in_session(query)
     return [n for n in usernames if n.name != user.name]
 
 
@@ -1,11 +1,14 @@
+import aioredis
+import asyncio
 import click
 import logging
+import texttable
 import hourai.config
 from hourai import web
 from hourai.bot import Hourai
+from hourai.db import benchmarks, compression, migrate
 from hourai.db.storage import Storage
 from hourai.db.models import Base
-from sqlalchemy import select
 
 
 @click.group()
@@ -62,16 +65,103 @@ def create(ctx):
 @click.pass_context
 @click.argument('src')
 @click.argument('dst')
-def move(ctx, src, dst):
+@click.option('--chunk-size', default=migrate.DEFAULT_CHUNK_SIZE, type=int)
+@click.option('-w', '--workers', default=migrate.DEFAULT_WORKERS, type=int)
+def move(ctx, src, dst, chunk_size, workers):
     storage = Storage(ctx.obj['config'])
     src_engine = storage._create_sql_engine(src)
     dst_engine = storage._create_sql_engine(dst)
+    migrate.move_tables(Base.metadata.sorted_tables, src_engine, dst_engine,
+                        chunk_size=chunk_size, workers=workers)
 
-    with src_engine.connect() as src_conn:
-        with dst_engine.connect():
-            for table in Base.metadata.sorted_tables:
-                data = [dict(row) for row in src_conn.execute(select(table.c))]
-                dst_engine.execute(table.insert().values(data))
+
+@main.group()
+@click.pass_context
+def bench(ctx):
+    pass
+
+
+@bench.command(name='redis')
+@click.pass_context
+@click.option('-s', '--size', 'sizes', multiple=True, type=int,
+              default=benchmarks.DEFAULT_REDIS_BATCH_SIZES)
+@click.option('-r', '--repeats', default=3, type=int)
+def bench_redis(ctx, sizes, repeats):
+    async def run():
+        redis = await _create_redis(ctx.obj['config'])
+        try:
+            return await benchmarks.benchmark_redis_batches(
+                redis, sizes=sizes, repeats=repeats)
+        finally:
+            redis.close()
+            await redis.wait_closed()
+
+    table = texttable.Texttable()
+    table.set_deco(texttable.Texttable.HEADER | texttable.Texttable.VLINES)
+    table.header(('Command', 'Batch Size', 'Mode', 'Best Time (s)',
+                  'Commands/s'))
+    for name, size, mode, elapsed in asyncio.run(run()):
+        table.add_row((name, size, mode, elapsed, int(size / elapsed)))
+    click.echo(table.draw())
+
+
+@bench.command(name='compression')
+@click.pass_context
+@click.option('-d', '--dictionary', 'dictionary_path', type=click.Path(),
+              default=None)
+@click.option('-l', '--limit', default=benchmarks.DEFAULT_SAMPLE_LIMIT,
+              type=int)
+@click.option('-r', '--repeats', default=3, type=int)
+def bench_compression(ctx, dictionary_path, limit, repeats):
+    zstd_dict = None
+    if dictionary_path is not None:
+        with open(dictionary_path, 'rb') as f:
+            zstd_dict = f.read()
+    samples = asyncio.run(_sample_stored_values(ctx.obj['config'], limit))
+    results = benchmarks.benchmark_compression(samples, zstd_dict=zstd_dict,
+                                               repeats=repeats)
+
+    table = texttable.Texttable()
+    table.set_deco(texttable.Texttable.HEADER | texttable.Texttable.VLINES)
+    table.header(('Values', 'Coder', 'Count', 'Raw Bytes', 'Stored Bytes',
+                  'Ratio', 'Encode (us)', 'Decode (us)'))
+    for kind, name, count, raw, stored, encode, decode in results:
+        table.add_row((kind, name, count, raw, stored, stored / raw,
+                       encode * 1e6, decode * 1e6))
+    click.echo(table.draw())
+
+
+@db.command(name='train-dictionary')
+@click.pass_context
+@click.argument('output', type=click.Path())
+@click.option('-s', '--size', default=16 * 1024, type=int)
+@click.option('-l', '--limit', default=benchmarks.DEFAULT_SAMPLE_LIMIT,
+              type=int)
+def train_dictionary(ctx, output, size, limit):
+    samples = asyncio.run(_sample_stored_values(ctx.obj['config'], limit))
+    zstd_dict = compression.train_zstd_dictionary(
+        [value for values in samples.values() for value in values],
+        size=size)
+    with open(output, 'wb') as f:
+        f.write(zstd_dict)
+    click.echo(f'Wrote {len(zstd_dict)} byte dictionary to {output}.')
+
+
+async def _create_redis(config):
+    return await aioredis.create_redis_pool(
+        hourai.config.get_config_value(config, 'redis', type=str))
+
+
+async def _sample_stored_values(config, limit):
+    storage = Storage(config)
+    redis = await _create_redis(config)
+    try:
+        return await benchmarks.sample_stored_values(
+            redis, limit=limit,
+            decoder=storage._create_compression_coder())
+    finally:
+        redis.close()
+        await redis.wait_closed()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,135 @@
+import asyncio
+import discord
+import types
+
+import pytest
+
+from hourai.bot import actions
+from hourai.db import proto
+
+GUILD_ID = 1
+USER_ID = 2
+ROLE_ID = 3
+
+
+class FakeMember:
+
+    def __init__(self, guild, voice=None):
+        self.guild = guild
+        self.voice = voice
+        self._roles = []
+        self.edits = []
+
+    async def edit(self, **kwargs):
+        self.edits.append(kwargs)
+
+
+class FakeGuild:
+
+    def __init__(self):
+        self.roles = {ROLE_ID: types.SimpleNamespace(id=ROLE_ID)}
+        self.member = None
+
+    def get_role(self, role_id):
+        return self.roles.get(role_id)
+
+    def get_member(self, user_id):
+        return self.member
+
+
+def make_voice(mute=False, deaf=False):
+    return discord.VoiceState(data={
+        'session_id': 'session', 'mute': mute, 'deaf': deaf,
+        'self_mute': False, 'self_deaf': False, 'self_video': False,
+        'suppress': False})
+
+
+def make_executor(voice=None):
+    guild = FakeGuild()
+    guild.member = FakeMember(guild, voice=voice)
+    scheduled = []
+    bot = types.SimpleNamespace(
+        get_guild=lambda guild_id: guild,
+        logger=types.SimpleNamespace(exception=pytest.fail),
+        action_manager=types.SimpleNamespace(
+            schedule=lambda timestamp, action: scheduled.append(action)))
+    guild.member.scheduled = scheduled
+    return actions.ActionExecutor(bot), guild.member
+
+
+def make_action(action_type, duration=None):
+    action = proto.Action(guild_id=GUILD_ID, user_id=USER_ID)
+    if duration is not None:
+        action.duration = duration
+    details = getattr(action, action_type)
+    details.type = proto.StatusType.APPLY
+    if action_type == 'change_role':
+        details.role_ids.append(ROLE_ID)
+    return action
+
+
+def make_actions():
+    return [make_action('change_role'), make_action('mute')]
+
+
+def test_member_edit_merges_roles_and_voice():
+    executor, member = make_executor(voice=make_voice())
+    asyncio.run(executor.sequentially_execute(make_actions()))
+    assert len(member.edits) == 1
+    assert member.edits[0]['mute'] is True
+    assert [r.id for r in member.edits[0]['roles']] == [ROLE_ID]
+
+
+def test_member_edit_merges_roles_and_deafen():
+    executor, member = make_executor(voice=make_voice())
+    asyncio.run(executor.sequentially_execute(
+        [make_action('change_role'), make_action('deafen')]))
+    assert len(member.edits) == 1
+    assert member.edits[0]['deafen'] is True
+    assert [r.id for r in member.edits[0]['roles']] == [ROLE_ID]
+
+
+def test_member_edit_skips_unchanged_voice_state():
+    executor, member = make_executor(voice=make_voice(deaf=True))
+    asyncio.run(executor.execute(make_action('deafen', duration=60)))
+    assert member.edits == []
+    assert member.scheduled == []
+
+
+def test_member_edit_skips_voice_when_not_connected():
+    executor, member = make_executor(voice=None)
+    asyncio.run(executor.sequentially_execute(make_actions()))
+    assert len(member.edits) == 1
+    assert 'mute' not in member.edits[0]
+    assert [r.id for r in member.edits[0]['roles']] == [ROLE_ID]
+
+
+def test_member_edit_skips_voice_only_edit_when_not_connected():
+    executor, member = make_executor(voice=None)
+    asyncio.run(executor.sequentially_execute(make_actions()[1:] * 2))
+    assert member.edits == []
+
+
+def test_voice_action_not_undone_when_not_connected():
+    executor, member = make_executor(voice=None)
+    asyncio.run(executor.sequentially_execute(
+        [make_action('change_role', duration=60),
+         make_action('mute', duration=60)]))
+    assert len(member.edits) == 1
+    assert [a.WhichOneof('details') for a in member.scheduled] == \
+        ['change_role']
+
+
+def test_single_voice_action_skipped_when_not_connected():
+    executor, member = make_executor(voice=None)
+    asyncio.run(executor.execute(make_action('deafen', duration=60)))
+    assert member.edits == []
+    assert member.scheduled == []
+
+
+def test_unsupported_action_type():
+    executor, _ = make_executor()
+    action = proto.Action(guild_id=GUILD_ID, user_id=USER_ID)
+    action.send_message.content = 'hello'
+    with pytest.raises(ValueError):
+        asyncio.run(executor.execute(action))